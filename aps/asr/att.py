@@ -21,6 +21,7 @@ from aps.asr.xfmr.decoder import TorchTransformerDecoder
 from aps.asr.xfmr.impl import TransformerEncoderLayers
 from aps.asr.base.attention import att_instance
 from aps.libs import ApsRegisters
+from aps.utils import inference_mode
 
 NoneOrTensor = Optional[th.Tensor]
 ASROutputType = Tuple[th.Tensor, NoneOrTensor, NoneOrTensor, NoneOrTensor]
@@ -38,6 +39,7 @@ class EncDecASRBase(nn.Module):
                  eos: int = -1,
                  ctc: bool = False,
                  asr_transform: Optional[nn.Module] = None,
+                 precompute_features: bool = False,
                  enc_type: str = "pytorch_rnn",
                  enc_proj: Optional[int] = None,
                  enc_kwargs: Optional[Dict] = None) -> None:
@@ -47,6 +49,9 @@ class EncDecASRBase(nn.Module):
         self.sos = sos
         self.eos = eos
         self.asr_transform = asr_transform
+        # if true, training features come from the dataloader (computed by
+        # TransformCollate) and asr_transform is only used in decoding
+        self.precompute_features = precompute_features
         if enc_type in TransformerEncoderLayers:
             self.encoder = TransformerEncoder(enc_type, input_size,
                                               **enc_kwargs)
@@ -129,7 +134,7 @@ class EncDecASRBase(nn.Module):
             tgt_pad: N x To+1
         """
         # asr feature transform
-        if self.asr_transform:
+        if self.asr_transform and not self.precompute_features:
             x_pad, x_len = self.asr_transform(x_pad, x_len)
         # N x Ti x D
         enc_out, enc_len = self.encoder(x_pad, x_len)
@@ -155,6 +160,7 @@ class AttASR(EncDecASRBase):
                  eos: int = -1,
                  ctc: bool = False,
                  asr_transform: Optional[nn.Module] = None,
+                 precompute_features: bool = False,
                  att_type: str = "ctx",
                  att_kwargs: Optional[Dict] = None,
                  enc_type: str = "common",
@@ -169,6 +175,7 @@ class AttASR(EncDecASRBase):
                                      eos=eos,
                                      ctc=ctc,
                                      asr_transform=asr_transform,
+                                     precompute_features=precompute_features,
                                      enc_type=enc_type,
                                      enc_proj=enc_proj,
                                      enc_kwargs=enc_kwargs)
@@ -221,7 +228,7 @@ class AttASR(EncDecASRBase):
         Args
             x: audio samples or acoustic features, S or Ti x F
         """
-        with th.no_grad():
+        with inference_mode():
             enc_out = self._decoding_prep(x)
             return att_api.greedy_search(self.decoder,
                                          self.att_net,
@@ -236,7 +243,7 @@ class AttASR(EncDecASRBase):
         Args
             x (Tensor): audio samples or acoustic features, S or Ti x F
         """
-        with th.no_grad():
+        with inference_mode():
             enc_out = self._decoding_prep(x)
             return att_api.beam_search(self.decoder,
                                        self.att_net,
@@ -251,7 +258,7 @@ class AttASR(EncDecASRBase):
         Args
             batch (list[Tensor]): audio samples or acoustic features, S or Ti x F
         """
-        with th.no_grad():
+        with inference_mode():
             enc_out, enc_len = self._batch_decoding_prep(batch)
             return att_api.beam_search_batch(self.decoder,
                                              self.att_net,
@@ -275,6 +282,7 @@ class XfmrASR(EncDecASRBase):
                  eos: int = -1,
                  ctc: bool = False,
                  asr_transform: Optional[nn.Module] = None,
+                 precompute_features: bool = False,
                  enc_type: str = "xfmr_abs",
                  dec_type: str = "xfmr_abs",
                  enc_proj: Optional[int] = None,
@@ -286,6 +294,7 @@ class XfmrASR(EncDecASRBase):
                                       eos=eos,
                                       ctc=ctc,
                                       asr_transform=asr_transform,
+                                      precompute_features=precompute_features,
                                       enc_type=enc_type,
                                       enc_proj=enc_proj,
                                       enc_kwargs=enc_kwargs)
@@ -328,7 +337,7 @@ class XfmrASR(EncDecASRBase):
         Args
             x: audio samples or acoustic features, S or Ti x F
         """
-        with th.no_grad():
+        with inference_mode():
             enc_out = self._decoding_prep(x, batch_first=False)
             return xfmr_api.greedy_search(self.decoder,
                                           enc_out,
@@ -340,7 +349,7 @@ class XfmrASR(EncDecASRBase):
         """
         Beam search for Transformer
         """
-        with th.no_grad():
+        with inference_mode():
             enc_out = self._decoding_prep(x, batch_first=False)
             # beam search
             return xfmr_api.beam_search(self.decoder,
@@ -353,7 +362,7 @@ class XfmrASR(EncDecASRBase):
         """
         Beam search for Transformer (batch version)
         """
-        with th.no_grad():
+        with inference_mode():
             enc_out, enc_len = self._batch_decoding_prep(batch,
                                                          batch_first=False)
             # beam search
@@ -27,11 +27,10 @@ def padding_mask(vec: th.Tensor, device: th.device = None) -> th.Tensor:
             [False, False, False, False, False, False],
             [False,  True,  True,  True,  True,  True]])
     """
-    N = vec.nelement()
     # vector may not in sorted order
     M = vec.max().item()
-    templ = th.arange(M, device=vec.device).repeat([N, 1])
-    mask = (templ >= vec.unsqueeze(1))
+    # broadcast instead of repeating the template N times
+    mask = th.arange(M, device=vec.device)[None, :] >= vec[:, None]
     return mask.to(device) if device is not None else mask
 
 
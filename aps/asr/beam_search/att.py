@@ -13,6 +13,7 @@ from typing import Optional, List, Dict
 from aps.asr.beam_search.utils import BeamSearchParam, BeamTracker, BatchBeamTracker
 from aps.asr.beam_search.lm import lm_score_impl, adjust_hidden, LmType
 from aps.utils import get_logger
+from aps.const import NEG_INF
 
 logger = get_logger(__name__)
 
@@ -183,13 +184,18 @@ def beam_search_batch(decoder: nn.Module,
                       cov_penalty: float = 0,
                       temperature: float = 1,
                       cov_threshold: float = 0.5,
-                      eos_threshold: float = 1) -> List[List[Dict]]:
+                      eos_threshold: float = 1,
+                      early_stop: bool = False) -> List[List[Dict]]:
     """
     Batch level vectorized beam search algothrim
     Args
         att_net (nn.Module): attention network
         enc_out (Tensor): N x T x F, encoder output
         enc_len (Tensor): N, length of the encoder output
+        early_stop (bool): remove the finished utterances from the decoder
+                           states instead of decoding them until all ends.
+                           They stop collecting hypotheses then (as in
+                           beam_search), so the nbest list may differ
     """
     if sos < 0 or eos < 0:
         raise RuntimeError(f"Invalid SOS/EOS ID: {sos:d}/{eos:d}")
@@ -231,16 +237,37 @@ def beam_search_batch(decoder: nn.Module,
                                  len_penalty=len_penalty,
                                  cov_penalty=cov_penalty,
                                  cov_threshold=cov_threshold,
-                                 eos_threshold=eos_threshold)
+                                 eos_threshold=eos_threshold,
+                                 early_stop=early_stop)
     beam_tracker = BatchBeamTracker(N, beam_param)
 
     # clear states
     att_net.clear()
+    # rows (N*beam) kept in the decoder states (None: all of them) and
+    # the mapping from the rows to their index in the decoder states
+    active, row_map = None, None
+    num_stop = 0
+    enc_all = enc_out
     # step by step
     stop = False
     while not stop:
         # N*beam
         pre_tok, point = beam_tracker[-1]
+        prev_map = row_map
+        # batch pruning: drop the finished utterances
+        if early_stop and sum(beam_tracker.auto_stop) > num_stop:
+            num_stop = sum(beam_tracker.auto_stop)
+            active = beam_tracker.active_rows()
+            row_map = th.full_like(point, -1)
+            row_map[active] = th.arange(active.shape[0], device=device)
+            enc_out = th.index_select(enc_all, 0, active)
+            # enc_part cached in att_net is out of date
+            att_net.clear()
+        if active is not None:
+            pre_tok = pre_tok[active]
+            point = point[active]
+            if prev_map is not None:
+                point = prev_map[point]
         # step forward
         dec_hid = adjust_hidden(point, dec_hid)
         att_ali = None if att_ali is None else att_ali[point]
@@ -262,6 +289,20 @@ def beam_search_batch(decoder: nn.Module,
             lm_prob = 0
 
         # one beam search step
-        stop = beam_tracker.step(am_prob, lm_prob, att_ali=att_ali)
+        if active is None:
+            stop = beam_tracker.step(am_prob, lm_prob, att_ali=att_ali)
+        else:
+            # scatter back to N*beam rows, finished ones only emit eos
+            am_full = am_prob.new_full((N * beam_size, am_prob.shape[-1]),
+                                       NEG_INF)
+            am_full[:, eos] = 0
+            am_full[active] = am_prob
+            if isinstance(lm_prob, th.Tensor):
+                lm_full = th.zeros_like(am_full)
+                lm_full[active] = lm_prob
+                lm_prob = lm_full
+            ali_full = att_ali.new_zeros((N * beam_size,) + att_ali.shape[1:])
+            ali_full[active] = att_ali
+            stop = beam_tracker.step(am_full, lm_prob, att_ali=ali_full)
     # return nbest
     return beam_tracker.nbest_hypos(nbest, auto_stop=stop)
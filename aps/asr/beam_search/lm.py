@@ -7,24 +7,28 @@ import torch as th
 import torch.nn as nn
 import torch.nn.functional as tf
 
-from typing import Union, Tuple
+from typing import Union, Tuple, List
 from aps.asr.lm.ngram import NgramLM
 
-HiddenType = Union[th.Tensor, Tuple[th.Tensor, th.Tensor]]
+HiddenType = Union[th.Tensor, Tuple[th.Tensor, th.Tensor],
+                   List[Tuple[th.Tensor, th.Tensor]]]
 LmType = Union[nn.Module, NgramLM]
 
 
 def adjust_hidden(back_point: th.Tensor, state: HiddenType) -> HiddenType:
     """
-    Adjust RNN hidden states
+    Adjust RNN hidden states (or key/value cache of the transformer LM)
     Args:
         back_point (Tensor): N
-        state (None or Tensor, [Tensor, Tensor])
+        state (None or Tensor, [Tensor, Tensor], list[[Tensor, Tensor]])
     Return:
-        state (None or Tensor, [Tensor, Tensor])
+        state (None or Tensor, [Tensor, Tensor], list[[Tensor, Tensor]])
     """
     if state is not None:
-        if isinstance(state, tuple):
+        if isinstance(state, list):
+            # key/value cache of each layer, shape: T, batch, ...
+            state = [(k[:, back_point], v[:, back_point]) for k, v in state]
+        elif isinstance(state, tuple):
             # shape: num_layers * num_directions, batch, hidden_size
             h, c = state
             state = (h[:, back_point], c[:, back_point])
@@ -65,10 +69,17 @@ def rnnlm_score(rnnlm: nn.Module, back_point: th.Tensor, prev_token: th.Tensor,
         score (Tensor): beam x V
         state (HiddenType): new hidden state
     """
-    # adjust order
-    state = adjust_hidden(back_point, state)
-    # LM
-    lmout, state = rnnlm(prev_token[..., None], state)
+    if isinstance(state, list):
+        # key/value cache of the transformer LM, which is reordered
+        # while appending the new step (avoid one more copy)
+        lmout, state = rnnlm(prev_token[..., None],
+                             state,
+                             back_point=back_point)
+    else:
+        # adjust order
+        state = adjust_hidden(back_point, state)
+        # LM
+        lmout, state = rnnlm(prev_token[..., None], state)
     # beam x V
     score = tf.log_softmax(lmout[:, 0], dim=-1)
     # return state & score
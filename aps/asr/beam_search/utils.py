@@ -35,6 +35,7 @@ class BeamSearchParam(object):
     cov_threshold: float = 0.5
     len_norm: bool = True
     end_detect: bool = False
+    early_stop: bool = False
 
 
 class BaseBeamTracker(object):
@@ -425,6 +426,16 @@ class BatchBeamTracker(BaseBeamTracker):
         token = self.token[t]
         return (token.view(-1), point.view(-1))
 
+    def active_rows(self) -> th.Tensor:
+        """
+        Return the index of the rows (N*beam) of the utterances still in search
+        """
+        beam = self.param.beam_size
+        utt = [u for u, stop in enumerate(self.auto_stop) if not stop]
+        utt = th.tensor(utt, device=self.score.device)
+        rows = utt[:, None] * beam + th.arange(beam, device=utt.device)
+        return rows.view(-1)
+
     def _trace_back(self, batch, final: bool = False) -> Optional[List[Dict]]:
         """
         Return end flags
@@ -560,6 +571,9 @@ class BatchBeamTracker(BaseBeamTracker):
         self.step_num += 1
         # trace back ended sequence (process eos nodes)
         for u in range(self.batch_size):
+            # utterance u is pruned from the search (early_stop), skip
+            if self.param.early_stop and self.auto_stop[u]:
+                continue
             # reach the max_len of utterance u, skip
             max_len = self.param.max_len[u]
             if self.step_num >= max_len:
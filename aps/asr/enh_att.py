@@ -6,10 +6,11 @@
 import torch as th
 import torch.nn as nn
 
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 from aps.asr.att import AttASR, XfmrASR, NoneOrTensor, ASROutputType
 from aps.asr.filter.conv import EnhFrontEnds
 from aps.libs import ApsRegisters
+from aps.utils import compiled, inference_mode
 
 
 def get_enh_net(enh_type: str,
@@ -60,6 +61,30 @@ class EnhASRBase(nn.Module):
                                    enh_kwargs,
                                    enh_input_size=enh_input_size)
         self.enh_type = enh_type
+        self.quantized = False
+
+    @compiled
+    def _enhance(self, x_pad: th.Tensor,
+                 x_len: NoneOrTensor) -> Tuple[th.Tensor, NoneOrTensor]:
+        """
+        Enhancement front-end (and feature transform for ASR if needed)
+        Args:
+            x_pad: N x C x S
+            x_len: N or None
+        Return:
+            x_enh: N x T x D
+            x_len: N or None
+        """
+        # feature for enhancement
+        feats, cstft, x_len = self.enh_transform(x_pad, x_len)
+        if self.enh_type[-4:] == "mvdr":
+            x_enh = self.enh_net(feats, cstft, inp_len=x_len)
+        else:
+            x_enh = self.enh_net(cstft)
+        # N x T x D, feature for ASR if needed
+        if self.asr_transform:
+            x_enh, _ = self.asr_transform(x_enh, None)
+        return x_enh, x_len
 
     def forward(self,
                 x_pad: th.Tensor,
@@ -79,39 +104,73 @@ class EnhASRBase(nn.Module):
             alis: N x (To+1) x T
             ...
         """
-        # feature for enhancement
-        feats, cstft, x_len = self.enh_transform(x_pad, x_len)
-        if self.enh_type[-4:] == "mvdr":
-            x_enh = self.enh_net(feats, cstft, inp_len=x_len)
-        else:
-            x_enh = self.enh_net(cstft)
-        # N x T x D, feature for ASR if needed
-        if self.asr_transform:
-            x_enh, _ = self.asr_transform(x_enh, None)
+        x_enh, x_len = self._enhance(x_pad, x_len)
         # outs, alis, ctc_branch, ...
         return self.asr(x_enh, x_len, y_pad, y_len, ssr=ssr)
 
-    def beam_search(self, x: th.Tensor, **kwargs) -> List[Dict]:
+    def _enhance_single(self, x: th.Tensor) -> th.Tensor:
+        """
+        Enhancement front-end for one utterance
+        Args:
+            x (Tensor): C x S
+        Return:
+            x_enh (Tensor): T x D
+        """
+        if x.dim() != 2:
+            raise RuntimeError("Now only support for one utterance")
+        # the transforms & beamformers work on batch, but adding/removing
+        # the leading axis here only creates views (no copy)
+        x_enh, _ = self._enhance(x[None, ...], None)
+        return x_enh[0]
+
+    def _quantize(self) -> None:
+        """
+        Quantize the enhancement network (int8) for inference if supported
+        """
+        if self.quantized:
+            return
+        if not hasattr(self.enh_net, "quantize_for_inference"):
+            raise RuntimeError(
+                f"Quantization is not supported for {self.enh_type}")
+        # dynamically quantized kernels only run on CPU
+        device = next(self.enh_net.parameters()).device
+        if device.type != "cpu":
+            raise RuntimeError(
+                f"Quantization is only supported on CPU, got {device}")
+        self.enh_net.quantize_for_inference()
+        self.quantized = True
+
+    def beam_search(self,
+                    x: th.Tensor,
+                    quantize: bool = False,
+                    **kwargs) -> List[Dict]:
         """
         Args
             x (Tensor): C x S
+            quantize (bool): run enhancement network in int8 (CPU only)
         """
-        with th.no_grad():
-            if x.dim() != 2:
-                raise RuntimeError("Now only support for one utterance")
-            x_enh, _ = self._enhance(x[None, ...], None)
-            return self.asr.beam_search(x_enh[0], **kwargs)
+        if quantize:
+            self._quantize()
+        with inference_mode():
+            x_enh = self._enhance_single(x)
+            return self.asr.beam_search(x_enh, **kwargs)
 
-    def beam_search_batch(self, batch: List[th.Tensor], **kwargs) -> List[Dict]:
+    def beam_search_batch(self,
+                          batch: List[th.Tensor],
+                          quantize: bool = False,
+                          **kwargs) -> List[Dict]:
         """
         Args
             batch (list[Tensor]): [C x S, ...]
+            quantize (bool): run enhancement network in int8 (CPU only)
         """
-        with th.no_grad():
-            batch_enh = []
-            for inp in batch:
-                x_enh, _ = self._enhance(inp, None)
-                batch_enh.append(x_enh[0])
+        if quantize:
+            self._quantize()
+        with inference_mode():
+            # NOTE: do not pad & enhance them as one batch, as the
+            # utterance-level normalization in enh_transform is not aware
+            # of the padding
+            batch_enh = [self._enhance_single(inp) for inp in batch]
             return self.asr.beam_search_batch(batch_enh, **kwargs)
 
 
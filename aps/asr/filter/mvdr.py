@@ -13,6 +13,7 @@ from aps.asr.base.encoder import PyTorchRNNEncoder
 from aps.asr.filter.conv import EnhFrontEnds
 from aps.const import EPSILON
 from aps.cplx import ComplexTensor
+from aps.utils import bf16_supported
 from typing import Optional
 
 
@@ -40,12 +41,14 @@ def beamform(weight: ComplexTensor,
 
 
 def estimate_covar(mask: th.Tensor,
-                   spectrogram: ComplexTensor) -> ComplexTensor:
+                   spectrogram: ComplexTensor,
+                   bf16: bool = False) -> ComplexTensor:
     """
     Covariance matrices (PSD) estimation
     Args:
         mask: TF-masks (real), N x F x T
         spectrogram: complex, N x C x F x T
+        bf16: do the matmul in bfloat16 (accumulated in fp32 on tensor cores)
     Return:
         covar: complex, N x F x C x C
     """
@@ -54,7 +57,11 @@ def estimate_covar(mask: th.Tensor,
     # N x F x 1 x T
     mask = mask.unsqueeze(-2)
     # N x F x C x C: einsum("...it,...jt->...ij", spec * mask, spec.conj())
-    nominator = (spec * mask) @ spec.conj_transpose(-1, -2)
+    if bf16:
+        nominator = ((spec * mask).to(th.bfloat16) @ spec.conj_transpose(
+            -1, -2).to(th.bfloat16)).to(th.float32)
+    else:
+        nominator = (spec * mask) @ spec.conj_transpose(-1, -2)
     # N x F x 1 x 1
     denominator = th.clamp(mask.sum(-1, keepdims=True), min=EPSILON)
     # N x F x C x C
@@ -66,11 +73,17 @@ class MvdrBeamformer(nn.Module):
     MVDR (Minimum Variance Distortionless Response) Beamformer
     """
 
-    def __init__(self, num_bins, att_dim=512, mask_norm=True, eps=1e-5):
+    def __init__(self,
+                 num_bins,
+                 att_dim=512,
+                 mask_norm=True,
+                 eps=1e-5,
+                 bf16_covar=False):
         super(MvdrBeamformer, self).__init__()
         self.ref = ChannelAttention(num_bins, att_dim)
         self.mask_norm = mask_norm
         self.eps = eps
+        self.bf16_covar = bf16_covar
 
     def _derive_weight(self,
                        Rs: ComplexTensor,
@@ -122,18 +135,28 @@ class MvdrBeamformer(nn.Module):
                 x_len: Optional[th.Tensor] = None) -> ComplexTensor:
         """
         Args:
-            mask_s: real TF-masks (speech), N x T x F
+            mask_s: real TF-masks (speech), N x T x F, or N x T x 2F
+                    (concatenated speech & noise masks, then mask_n is None)
             x: noisy complex spectrogram, N x C x F x T
             mask_n: real TF-masks (noise), N x T x F
         Return:
             y: enhanced complex spectrogram N x T x F
         """
-        # N x F x T
-        mask_s = self._process_mask(mask_s, x_len=x_len)
-        mask_n = self._process_mask(mask_n, x_len=x_len)
-        # N x F x C x C
-        Rs = estimate_covar(mask_s, x)
-        Rn = estimate_covar(1 - mask_s if mask_n is None else mask_n, x)
+        F = x.shape[2]
+        if mask_n is None and mask_s.shape[-1] == F * 2:
+            # process speech & noise masks in one go, N x 2F x T
+            masks = self._process_mask(mask_s, x_len=x_len)
+            mask_s, mask_n = masks[:, :F], masks[:, F:]
+        else:
+            # N x F x T
+            mask_s = self._process_mask(mask_s, x_len=x_len)
+            mask_n = self._process_mask(mask_n, x_len=x_len)
+        # N x F x C x C, the inverse & weights are still computed in fp32
+        bf16 = self.bf16_covar and bf16_supported(x.real)
+        Rs = estimate_covar(mask_s, x, bf16=bf16)
+        Rn = estimate_covar(1 - mask_s if mask_n is None else mask_n,
+                            x,
+                            bf16=bf16)
         # N x C
         u = self.ref(Rs)
         # N x F x C
@@ -191,7 +214,8 @@ class RNNMaskMvdr(nn.Module):
                  bidirectional: bool = True,
                  mask_net_noise: bool = True,
                  mvdr_att_dim: int = 512,
-                 mask_norm: bool = True):
+                 mask_norm: bool = True,
+                 bf16_covar: bool = False):
         super(RNNMaskMvdr, self).__init__()
         # TF-mask estimation network
         self.mask_net = PyTorchRNNEncoder(enh_input_size,
@@ -207,9 +231,19 @@ class RNNMaskMvdr(nn.Module):
         # MVDR beamformer
         self.mvdr_net = MvdrBeamformer(num_bins,
                                        att_dim=mvdr_att_dim,
-                                       mask_norm=mask_norm)
+                                       mask_norm=mask_norm,
+                                       bf16_covar=bf16_covar)
         self.mask_net_noise = mask_net_noise
 
+    def quantize_for_inference(self) -> None:
+        """
+        Dynamic int8 quantization of the mask estimation network (for CPU
+        inference only). The MVDR beamformer is kept in FP32 as the matrix
+        inversion is numerically sensitive
+        """
+        self.mask_net = th.quantization.quantize_dynamic(
+            self.mask_net, {nn.LSTM, nn.GRU, nn.Linear}, dtype=th.qint8)
+
     def forward(self,
                 feats: th.Tensor,
                 cstft: ComplexTensor,
@@ -223,12 +257,8 @@ class RNNMaskMvdr(nn.Module):
         Return:
             enh (ComplexTensor): N x T x F
         """
-        # TF-mask estimation: N x T x F
+        # TF-mask estimation: N x T x F (or 2F if mask_net_noise = True)
         mask, _ = self.mask_net(feats, inp_len)
-        if self.mask_net_noise:
-            mask_s, mask_n = th.chunk(mask, 2, dim=-1)
-        else:
-            mask_s, mask_n = mask, None
         # mvdr beamforming: N x T x F
-        enh = self.mvdr_net(mask_s, cstft, x_len=inp_len, mask_n=mask_n)
+        enh = self.mvdr_net(mask, cstft, x_len=inp_len)
         return enh
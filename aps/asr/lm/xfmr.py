@@ -4,12 +4,14 @@
 import torch as th
 import torch.nn as nn
 
-from typing import Optional, Tuple
+from typing import Optional, Tuple, List
 from aps.asr.xfmr.pose import get_xfmr_pose
 from aps.asr.xfmr.impl import get_xfmr_encoder
 from aps.asr.xfmr.decoder import prep_sub_mask
-from aps.asr.base.attention import padding_mask
 from aps.libs import ApsRegisters
+from aps.utils import compiled
+
+KVCache = List[Tuple[th.Tensor, th.Tensor]]
 
 
 @ApsRegisters.asr.register("asr@xfmr_lm")
@@ -44,35 +46,79 @@ class TorchXfmrLM(nn.Module):
         # output distribution
         self.dist = nn.Linear(att_dim, vocab_size)
         self.vocab_size = vocab_size
+        # causal mask shared by all the calls (grow on demand)
+        self.register_buffer("causal_mask", None, persistent=False)
+
+    def sub_mask(self, beg: int, end: int, device: th.device) -> th.Tensor:
+        """
+        Return causal mask (-inf/0) for time step [beg, end), (end - beg) x end
+        """
+        cur_len = 0 if self.causal_mask is None else self.causal_mask.shape[0]
+        if cur_len < end or self.causal_mask.device != device:
+            self.causal_mask = prep_sub_mask(max(end, cur_len * 2),
+                                             device=device)
+        return self.causal_mask[beg:end, :end]
+
+    @compiled
+    def encoder_step(
+            self, x: th.Tensor, h: Optional[KVCache], mask: Optional[th.Tensor],
+            back_point: Optional[th.Tensor]) -> Tuple[th.Tensor, KVCache]:
+        """
+        Run self.encoder.step (compiled if APS_TORCH_COMPILE=1)
+        """
+        return self.encoder.step(x, cache=h, mask=mask, back_point=back_point)
 
     def forward(
-            self,
-            token: th.Tensor,
-            h: Optional[th.Tensor] = None,
-            token_len: Optional[th.Tensor] = None
-    ) -> Tuple[th.Tensor, th.Tensor]:
+        self,
+        token: th.Tensor,
+        h: Optional[KVCache] = None,
+        token_len: Optional[th.Tensor] = None,
+        back_point: Optional[th.Tensor] = None
+    ) -> Tuple[th.Tensor, Optional[KVCache]]:
         """
         args:
             token: input token sequence, N x T
-            h: previous sequence embeddings, T x N x E
+            h: key/value cache of the previous steps (list of (T x N x H x D, T x N x H x D))
             token_len: length of x, N or None
+            back_point: reorder h (beam search) when appending to the cache, N or None
         return:
             output: N x T x V
-            h: current sequence embeddings, T x N x E
+            h: updated key/value cache (None in training)
         """
-        # N x T => T x N x V
-        t = 0 if h is None else h.shape[0]
-        x = self.abs_pos_enc(self.vocab_embed(token), t=t)
-        # h == None: training or eval in time = 0
-        h = x if h is None else th.cat([h, x], dim=0)
-        # src_pad_mask: N x T
-        src_pad_mask = None if token_len is None else (padding_mask(token_len)
-                                                       == 1)
-        tgt_mask = prep_sub_mask(t + 1, device=x.device)
-        # N x Ti x D
-        enc_out = self.encoder(h,
-                               mask=tgt_mask,
-                               src_key_padding_mask=src_pad_mask)
-        # N x Ti x V
-        output = self.dist(enc_out)
+        if self.training:
+            return self._train_forward(token, token_len), None
+        # incremental decoding: only process the new tokens
+        t = 0 if h is None else h[0][0].shape[0]
+        # N x L => L x N x E, embed the transposed tokens directly
+        x = self.abs_pos_enc.step(self.vocab_embed(token.t()), t=t)
+        L = x.shape[0]
+        # L x (t + L), causal mask for the new tokens
+        tgt_mask = None if L == 1 else self.sub_mask(t, t + L, x.device)
+        # L x N x E
+        enc_out, h = self.encoder_step(x, h, tgt_mask, back_point)
+        # N x L x V
+        output = self.dist(enc_out).transpose(0, 1)
         return output, h
+
+    def _train_forward(self,
+                       token: th.Tensor,
+                       token_len: Optional[th.Tensor] = None) -> th.Tensor:
+        """
+        args:
+            token: input token sequence, N x T
+            token_len: length of x, N or None (unused, see below)
+        return:
+            output: N x T x V
+        """
+        # N x T => T x N x E
+        x = self.abs_pos_enc(self.vocab_embed(token), t=0)
+        # NOTE: the sequences are right padded, so under the (additive float)
+        # causal mask, the valid positions never attend to the padded ones,
+        # and the key padding mask is redundant. Use the causal mask only
+        # to avoid mixing boolean & float masks in each attention layer.
+        tgt_mask = self.sub_mask(0, x.shape[0], x.device)
+        # T x N x E
+        enc_out = self.encoder(x, src_mask=tgt_mask)
+        # N x T x V
+        output = self.dist(enc_out).transpose(0, 1)
+        return output
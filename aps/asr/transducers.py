@@ -14,6 +14,7 @@ from aps.asr.base.encoder import encoder_instance
 from aps.asr.xfmr.impl import TransformerEncoderLayers
 from aps.asr.beam_search.transducer import greedy_search, beam_search
 from aps.libs import ApsRegisters
+from aps.utils import inference_mode
 
 NoneOrTensor = Optional[th.Tensor]
 TransducerOutputType = Tuple[th.Tensor, NoneOrTensor]
@@ -29,6 +30,7 @@ class TransducerASRBase(nn.Module):
                  vocab_size: int = 40,
                  blank: int = -1,
                  asr_transform: Optional[nn.Module] = None,
+                 precompute_features: bool = False,
                  enc_type: str = "xfmr_abs",
                  enc_proj: Optional[int] = None,
                  enc_kwargs: Optional[Dict] = None) -> None:
@@ -37,6 +39,9 @@ class TransducerASRBase(nn.Module):
             raise RuntimeError(f"Unsupported blank value: {blank}")
         self.blank = blank
         self.asr_transform = asr_transform
+        # if true, training features come from the dataloader (computed by
+        # TransformCollate) and asr_transform is only used in decoding
+        self.precompute_features = precompute_features
         if enc_type in TransformerEncoderLayers:
             self.is_xfmr_encoder = True
             self.encoder = TransformerEncoder(enc_type, input_size,
@@ -81,7 +86,7 @@ class TransducerASRBase(nn.Module):
         Parepare data for training
         """
         # feature transform
-        if self.asr_transform:
+        if self.asr_transform and not self.precompute_features:
             x_pad, x_len = self.asr_transform(x_pad, x_len)
         # N x Ti x D
         enc_out, enc_len = self.encoder(x_pad, x_len)
@@ -94,7 +99,7 @@ class TransducerASRBase(nn.Module):
         """
         Greedy search for TransducerASR
         """
-        with th.no_grad():
+        with inference_mode():
             enc_out = self._decoding_prep(x)
             return greedy_search(self.decoder, enc_out, blank=self.blank)
 
@@ -110,7 +115,7 @@ class TransducerASRBase(nn.Module):
         """
         Beam search for TransducerASR
         """
-        with th.no_grad():
+        with inference_mode():
             enc_out = self._decoding_prep(x)
             return beam_search(self.decoder,
                                enc_out,
@@ -133,18 +138,21 @@ class TransducerASR(TransducerASRBase):
                  vocab_size: int = 40,
                  blank: int = -1,
                  asr_transform: Optional[nn.Module] = None,
+                 precompute_features: bool = False,
                  enc_type: str = "xfmr_abs",
                  enc_proj: Optional[int] = None,
                  dec_type: str = "rnn",
                  enc_kwargs: Optional[Dict] = None,
                  dec_kwargs: Optional[Dict] = None) -> None:
-        super(TransducerASR, self).__init__(input_size=input_size,
-                                            vocab_size=vocab_size,
-                                            blank=blank,
-                                            asr_transform=asr_transform,
-                                            enc_type=enc_type,
-                                            enc_proj=enc_proj,
-                                            enc_kwargs=enc_kwargs)
+        super(TransducerASR,
+              self).__init__(input_size=input_size,
+                             vocab_size=vocab_size,
+                             blank=blank,
+                             asr_transform=asr_transform,
+                             precompute_features=precompute_features,
+                             enc_type=enc_type,
+                             enc_proj=enc_proj,
+                             enc_kwargs=enc_kwargs)
         if dec_type != "rnn":
             raise ValueError(
                 "TorchTransducerASR: currently decoder must be rnn")
@@ -183,18 +191,21 @@ class XfmrTransducerASR(TransducerASRBase):
                  vocab_size: int = 40,
                  blank: int = -1,
                  asr_transform: Optional[nn.Module] = None,
+                 precompute_features: bool = False,
                  enc_type: str = "xfmr_abs",
                  enc_proj: Optional[int] = None,
                  enc_kwargs: Optional[Dict] = None,
                  dec_type: str = "xfmr_abs",
                  dec_kwargs: Optional[Dict] = None) -> None:
-        super(XfmrTransducerASR, self).__init__(input_size=input_size,
-                                                vocab_size=vocab_size,
-                                                blank=blank,
-                                                asr_transform=asr_transform,
-                                                enc_type=enc_type,
-                                                enc_proj=enc_proj,
-                                                enc_kwargs=enc_kwargs)
+        super(XfmrTransducerASR,
+              self).__init__(input_size=input_size,
+                             vocab_size=vocab_size,
+                             blank=blank,
+                             asr_transform=asr_transform,
+                             precompute_features=precompute_features,
+                             enc_type=enc_type,
+                             enc_proj=enc_proj,
+                             enc_kwargs=enc_kwargs)
         if dec_type != "xfmr_abs":
             raise ValueError("TransformerTransducerASR: currently decoder "
                              "must be xfmr_abs")
@@ -172,8 +172,8 @@ class TorchTransformerDecoder(nn.Module):
         """
         # N x Ti
         offset = 0 if pre_emb is None else pre_emb.shape[0]
-        mem_pad_mask = None if enc_len is None else (padding_mask(enc_len) == 1)
-        tgt_pad_mask = None if tgt_len is None else (padding_mask(tgt_len) == 1)
+        mem_pad_mask = None if enc_len is None else padding_mask(enc_len)
+        tgt_pad_mask = None if tgt_len is None else padding_mask(tgt_len)
         # N x T x E
         tgt_emb = self.vocab_embed(tgt_pad)
         # T x N x E
@@ -74,7 +74,12 @@ class TransformerEncoder(nn.Module):
         """
         inp_len = self.proj.num_frames(inp_len)
         enc_inp = self.proj(inp_pad)
-        src_pad_mask = None if inp_len is None else (padding_mask(inp_len) == 1)
+        # skip the key padding mask (and the masking ops in each layer) if
+        # there is no padding in the batch, e.g., one utterance in decoding
+        if inp_len is None or inp_len.min().item() == enc_inp.shape[1]:
+            src_pad_mask = None
+        else:
+            src_pad_mask = padding_mask(inp_len)
 
         if self.type == "abs":
             # enc_inp: N x Ti x D => Ti x N x D
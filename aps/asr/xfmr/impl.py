@@ -10,7 +10,7 @@ import torch as th
 import torch.nn as nn
 import torch.nn.functional as tf
 
-from typing import Optional, Tuple
+from typing import Optional, Tuple, List
 from aps.libs import Register
 from aps.asr.xfmr.pose import digit_shift
 
@@ -59,6 +59,29 @@ def _get_relative_uv(shape: Tuple[int],
     return rel_mat
 
 
+def _append_cache(cache: th.Tensor,
+                  new: th.Tensor,
+                  back_point: Optional[th.Tensor] = None) -> th.Tensor:
+    """
+    Append new key/value to the cache in one allocation, with the
+    (optional) reordering of the cache written to the same buffer
+    Args:
+        cache (Tensor): T x N x ...
+        new (Tensor): L x N x ...
+        back_point (None or Tensor): N
+    Return:
+        out (Tensor): T + L x N x ...
+    """
+    T, L = cache.shape[0], new.shape[0]
+    out = new.new_empty((T + L,) + new.shape[1:])
+    if back_point is None:
+        out[:T] = cache
+    else:
+        th.index_select(cache, 1, back_point, out=out[:T])
+    out[T:] = new
+    return out
+
+
 class ApsMultiheadAttention(nn.Module):
     """
     My own MultiheadAttention and make sure it's same as torch.nn.MultiheadAttention
@@ -256,6 +279,39 @@ class ApsMultiheadAttention(nn.Module):
                                               key_padding_mask=key_padding_mask)
         return self.wrap_out(context, weight)
 
+    def step(
+        self,
+        query: th.Tensor,
+        cache: Optional[Tuple[th.Tensor, th.Tensor]] = None,
+        attn_mask: Optional[th.Tensor] = None,
+        back_point: Optional[th.Tensor] = None
+    ) -> Tuple[th.Tensor, Tuple[th.Tensor, th.Tensor]]:
+        """
+        Incremental self-attention with the cached key/value (for decoding)
+        Args:
+            query (Tensor): L x N x E, new coming inputs
+            cache (None or [Tensor, Tensor]): key/value of previous steps, T x N x H x D
+            attn_mask (Tensor): L x (T + L), additional mask
+            back_point (None or Tensor): N, reorder the cache (in beam search)
+        Return:
+            context (Tensor): L x N x E
+            cache ([Tensor, Tensor]): key/value of all steps, (T + L) x N x H x D
+        """
+        # L x N x HD*3, only project the new inputs
+        stack = tf.linear(query, self.in_proj_weight, self.in_proj_bias)
+        query, key, value = [
+            m.view(m.shape[0], -1, self.num_heads, self.head_dim)
+            for m in th.chunk(stack, 3, dim=-1)
+        ]
+        if cache is not None:
+            key = _append_cache(cache[0], key, back_point=back_point)
+            value = _append_cache(cache[1], value, back_point=back_point)
+        # L x N x H x S
+        logit = self.dot_att(query, key)
+        context, weight = self.context_weight(logit, value, attn_mask=attn_mask)
+        context, _ = self.wrap_out(context, weight)
+        return context, (key, value)
+
 
 class RelMultiheadAttention(ApsMultiheadAttention):
     """
@@ -454,7 +510,12 @@ class ApsTransformerEncoderLayer(nn.Module):
                                 inj_pose,
                                 attn_mask=src_mask,
                                 key_padding_mask=src_key_padding_mask)
-        src = inp + self.dropout(att)
+        return self._ffn(inp + self.dropout(att))
+
+    def _ffn(self, src: th.Tensor) -> th.Tensor:
+        """
+        Residual feedforward part of the layer
+        """
         if self.pre_norm:
             src = src + self.feedforward(self.norm2(src))
         else:
@@ -462,6 +523,32 @@ class ApsTransformerEncoderLayer(nn.Module):
             src = self.norm2(src + self.feedforward(src))
         return src
 
+    def step(
+        self,
+        src: th.Tensor,
+        cache: Optional[Tuple[th.Tensor, th.Tensor]] = None,
+        src_mask: Optional[th.Tensor] = None,
+        back_point: Optional[th.Tensor] = None
+    ) -> Tuple[th.Tensor, Tuple[th.Tensor, th.Tensor]]:
+        """
+        Args:
+            src (Tensor): L x N x D, new coming inputs
+            cache (None or [Tensor, Tensor]): key/value of previous steps
+            src_mask (None or Tensor): L x (T + L)
+            back_point (None or Tensor): N, reorder the cache
+        Return:
+            out (Tensor): L x N x D
+            cache ([Tensor, Tensor]): updated key/value
+        """
+        inp = src
+        if self.pre_norm:
+            src = self.norm1(src)
+        att, cache = self.self_attn.step(src,
+                                         cache=cache,
+                                         attn_mask=src_mask,
+                                         back_point=back_point)
+        return self._ffn(inp + self.dropout(att)), cache
+
 
 class ApsConformerEncoderLayer(nn.Module):
     """
@@ -753,6 +840,39 @@ class ApsTransformerEncoder(nn.Module):
 
         return out
 
+    def step(
+        self,
+        src: th.Tensor,
+        cache: Optional[List[Tuple[th.Tensor, th.Tensor]]] = None,
+        mask: Optional[th.Tensor] = None,
+        back_point: Optional[th.Tensor] = None
+    ) -> Tuple[th.Tensor, List[Tuple[th.Tensor, th.Tensor]]]:
+        """
+        Incremental forward using the per-layer key/value cache
+        Args:
+            src (Tensor): L x N x D, new coming inputs
+            cache (None or list): key/value cache of each layer
+            mask (None or Tensor): L x (T + L)
+            back_point (None or Tensor): N, reorder the cache (in beam search)
+        Return:
+            out (Tensor): L x N x D
+            cache (list): updated key/value cache of each layer
+        """
+        out = src
+        new_cache = []
+        for i, mod in enumerate(self.layers):
+            out, layer_cache = mod.step(
+                out,
+                cache=None if cache is None else cache[i],
+                src_mask=mask,
+                back_point=back_point)
+            new_cache.append(layer_cache)
+
+        if self.norm is not None:
+            out = self.norm(out)
+
+        return out, new_cache
+
 
 def get_xfmr_encoder(name: str,
                      num_layers: int,
@@ -153,6 +153,8 @@ class InputSinPosEncoding(SinPosEncoding):
                  scale_embed: bool = False) -> None:
         super(InputSinPosEncoding, self).__init__(embed_dim, dropout=dropout)
         self.factor = embed_dim**0.5 if scale_embed else 1
+        # cached encodings used in step()
+        self.register_buffer("pos_table", None, persistent=False)
 
     def forward(self, inp: th.Tensor, t: int = 0) -> th.Tensor:
         """
@@ -170,3 +172,20 @@ class InputSinPosEncoding(SinPosEncoding):
         # T x N x D
         out = out.transpose(0, 1)
         return out
+
+    def step(self, inp: th.Tensor, t: int = 0) -> th.Tensor:
+        """
+        Inference only version of forward (no dropout), with the encodings
+        looked up from a cached table
+        Args:
+            inp (Tensor): T x N x D
+        Return:
+            out (Tensor): T x N x D
+        """
+        end = t + inp.shape[0]
+        cur_len = 0 if self.pos_table is None else self.pos_table.shape[0]
+        if cur_len < end or self.pos_table.device != inp.device:
+            pos = th.arange(0, max(end, cur_len * 2), 1.0, device=inp.device)
+            self.pos_table = self._get_sin_pos_enc(pos)
+        # T x N x D
+        return inp * self.factor + self.pos_table[t:end, None]
@@ -4,7 +4,6 @@
 Load {am,lm,se} training configurations
 """
 import yaml
-import codecs
 
 from typing import Dict, List, Tuple
 
@@ -28,17 +27,20 @@ def load_dict(dict_path: str,
         required: required units in the dict
         reverse: return int:str if true, else str:int
     """
-    with codecs.open(dict_path, encoding="utf-8") as f:
-        vocab = {}
-        for line in f:
-            tok, idx = line.split()
-            if reverse:
-                vocab[int(idx)] = tok
-            else:
-                if tok in vocab:
+    # decode once and split in bulk: much faster than codecs line by line
+    with open(dict_path, "rb") as f:
+        pairs = [line.split() for line in f.read().decode("utf-8").splitlines()]
+    if reverse:
+        vocab = {int(idx): tok for tok, idx in pairs}
+    else:
+        vocab = {tok: int(idx) for tok, idx in pairs}
+        if len(vocab) != len(pairs):
+            seen = set()
+            for tok, _ in pairs:
+                if tok in seen:
                     raise RuntimeError(
                         f"Duplicated token in {dict_path}: {tok}")
-                vocab[tok] = int(idx)
+                seen.add(tok)
     if not reverse:
         for token in required:
             if token not in vocab:
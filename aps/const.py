@@ -14,3 +14,4 @@ MATH_PI = math.pi
 EPSILON = np.finfo(np.float32).eps
 MAX_INT16 = np.iinfo(np.int16).max
 UNK_TOKEN = "<unk>"
+TORCH_VERSION = tuple(int(v) for v in th.__version__.split(".")[:2])
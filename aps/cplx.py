@@ -11,8 +11,11 @@ import numpy as np
 
 from numbers import Number
 from typing import Optional, Union
+from aps.const import TORCH_VERSION
 
 OpObjType = Union[th.Tensor, Number, "ComplexTensor"]
+# use native complex kernels for matmul & inverse (well supported since 1.9)
+NATIVE_COMPLEX = TORCH_VERSION >= (1, 9)
 
 
 class ComplexTensor(object):
@@ -236,9 +239,29 @@ def _rdiv(other: OpObjType, tensor: ComplexTensor) -> ComplexTensor:
         return ComplexTensor(other * tensor.real, -other * tensor.imag)
 
 
+def _use_native(*tensors: ComplexTensor) -> bool:
+    """
+    Native complex kernels only for float32/float64 parts (th.complex
+    rejects bfloat16 and half complex kernels are hardly supported)
+    """
+    return NATIVE_COMPLEX and all(
+        t.real.dtype in [th.float32, th.float64] for t in tensors)
+
+
+def _native(tensor: ComplexTensor) -> th.Tensor:
+    return th.complex(tensor.real, tensor.imag)
+
+
+def _from_native(tensor: th.Tensor) -> ComplexTensor:
+    return ComplexTensor(tensor.real, tensor.imag)
+
+
 def _lmatmul(tensor: ComplexTensor,
              other: Union[th.Tensor, ComplexTensor]) -> ComplexTensor:
     if _is_complex(other):
+        if _use_native(tensor, other):
+            # one complex gemm instead of four real ones
+            return _from_native(th.matmul(_native(tensor), _native(other)))
         return ComplexTensor(
             th.matmul(tensor.real, other.real) -
             th.matmul(tensor.imag, other.imag),
@@ -252,6 +275,8 @@ def _lmatmul(tensor: ComplexTensor,
 def _rmatmul(other: Union[th.Tensor, ComplexTensor],
              tensor: ComplexTensor) -> ComplexTensor:
     if _is_complex(other):
+        if _use_native(other, tensor):
+            return _from_native(th.matmul(_native(other), _native(tensor)))
         return ComplexTensor(
             th.matmul(other.real, tensor.real) -
             th.matmul(other.imag, tensor.imag),
@@ -266,6 +291,9 @@ def _inverse(tensor: ComplexTensor) -> ComplexTensor:
     """
     Refer: A note on the inversion of complex matrices
     """
+    if _use_native(tensor):
+        # C x C complex instead of 2C x 2C real inversion
+        return _from_native(th.inverse(_native(tensor)))
     m = th.cat([tensor.real, -1.0 * tensor.imag], dim=-1)
     n = th.cat([tensor.imag, tensor.real], dim=-1)
     r = th.cat([m, n], dim=-2)
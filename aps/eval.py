@@ -91,25 +91,42 @@ class TextPostProcessor(object):
                  spm: str = "") -> None:
         self.unk = show_unk
         self.space = space
+        # for single character space symbol, use one str.translate pass
+        self.space_table = None
+        if len(space) == 1:
+            self.space_table = str.maketrans({space: " "})
         self.vocab = None
         self.sp_mdl = None
         if dict_str:
-            self.vocab = load_dict(dict_str, reverse=True)
+            # index -> unit, list lookup is cheaper than the dict one
+            vocab = load_dict(dict_str, reverse=True)
+            self.vocab = [None] * (max(vocab) + 1)
+            for idx, unit in vocab.items():
+                self.vocab[idx] = unit
         if spm:
             import sentencepiece as sp
             self.sp_mdl = sp.SentencePieceProcessor(model_file=spm)
 
     def run(self, int_seq: List[int]) -> str:
         if self.vocab:
-            trans = [self.vocab[idx] for idx in int_seq]
+            num_units = len(self.vocab)
+            # None for the ids not in the dict (negative ones included)
+            trans = [
+                self.vocab[idx] if 0 <= idx < num_units else None
+                for idx in int_seq
+            ]
+            if None in trans:
+                raise KeyError(int_seq[trans.index(None)])
         else:
-            trans = [str(idx) for idx in int_seq]
+            trans = list(map(str, int_seq))
         # char sequence
         if self.vocab:
             if self.sp_mdl:
                 trans = self.sp_mdl.decode(trans)
             else:
-                if self.space:
+                if self.space_table:
+                    trans = "".join(trans).translate(self.space_table)
+                elif self.space:
                     trans = "".join(trans).replace(self.space, " ")
                 else:
                     trans = " ".join(trans)
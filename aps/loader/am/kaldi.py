@@ -5,14 +5,10 @@
 """
 Dataloader for kaldi features
 """
-import torch as th
-
-from torch.nn.utils.rnn import pad_sequence
 from typing import Dict, Iterable, Optional
 from kaldi_python_io import ScriptReader
-from aps.loader.am.utils import AsrDataset, AsrDataLoader
+from aps.loader.am.utils import AsrDataset, AsrDataLoader, collate_egs
 from aps.libs import ApsRegisters
-from aps.const import IGNORE_ID
 
 
 @ApsRegisters.loader.register("am@kaldi")
@@ -32,7 +28,9 @@ def DataLoader(train: bool = True,
                batch_mode: str = "adaptive",
                num_workers: int = 0,
                max_batch_size: int = 32,
-               min_batch_size: int = 4) -> Iterable[Dict]:
+               min_batch_size: int = 4,
+               pin_memory: bool = True,
+               prefetch: int = 0) -> Iterable[Dict]:
     """
     Args:
         train: in training mode or not
@@ -49,6 +47,8 @@ def DataLoader(train: bool = True,
         num_workers: number of the workers
         max_batch_size: maximum #batch_size
         min_batch_size: minimum #batch_size
+        pin_memory: return the batches in pinned memory (if cuda is available)
+        prefetch: number of the batches prefetched in a background thread when num_workers == 0
     """
     dataset = Dataset(feats_scp,
                       text,
@@ -68,7 +68,9 @@ def DataLoader(train: bool = True,
                          adapt_token_num=adapt_token_num,
                          batch_mode=batch_mode,
                          max_batch_size=max_batch_size,
-                         min_batch_size=min_batch_size)
+                         min_batch_size=min_batch_size,
+                         pin_memory=pin_memory,
+                         prefetch=prefetch)
 
 
 class Dataset(AsrDataset):
@@ -117,21 +119,4 @@ def egs_collate(egs: Dict) -> Dict:
         src_len: number of the frames, N
         tgt_len: length of the tokens, N
     """
-
-    def pad_seq(olist, value=0):
-        return pad_sequence(olist, batch_first=True, padding_value=value)
-
-    return {
-        "#utt":
-            len(egs),
-        "#tok":  # add 1 as during training we pad sos
-            sum([int(eg["len"]) + 1 for eg in egs]),
-        "src_pad":
-            pad_seq([th.from_numpy(eg["inp"].copy()) for eg in egs], value=0),
-        "tgt_pad":
-            pad_seq([th.as_tensor(eg["ref"]) for eg in egs], value=IGNORE_ID),
-        "src_len":
-            th.tensor([int(eg["dur"]) for eg in egs], dtype=th.int64),
-        "tgt_len":
-            th.tensor([eg["len"] for eg in egs], dtype=th.int64)
-    }
+    return collate_egs(egs, time_axis=0)
@@ -31,7 +31,8 @@ def DataLoader(train: bool = True,
                batch_mode: str = "adaptive",
                num_workers: int = 0,
                max_batch_size: int = 32,
-               min_batch_size: int = 4) -> Iterable[Dict]:
+               min_batch_size: int = 4,
+               prefetch: int = 0) -> Iterable[Dict]:
     """
     Return the online simulation dataloader (for AM training)
     Args:
@@ -49,6 +50,7 @@ def DataLoader(train: bool = True,
         num_workers: number of the workers
         max_batch_size: maximum #batch_size
         min_batch_size: minimum #batch_size
+        prefetch: number of the batches prefetched in a background thread when num_workers == 0
     """
     dataset = Dataset(simu_cfg,
                       text,
@@ -67,7 +69,8 @@ def DataLoader(train: bool = True,
                          adapt_token_num=adapt_token_num,
                          batch_mode=batch_mode,
                          max_batch_size=max_batch_size,
-                         min_batch_size=min_batch_size)
+                         min_batch_size=min_batch_size,
+                         prefetch=prefetch)
 
 
 class AsrSimuReader(SimuOptionsDataset):
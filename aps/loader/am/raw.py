@@ -5,13 +5,9 @@
 """
 Dataloader for raw waveforms in asr tasks
 """
-import torch as th
-
-from torch.nn.utils.rnn import pad_sequence
 from typing import Dict, Iterable, Optional
-from aps.loader.am.utils import AsrDataset, AsrDataLoader
+from aps.loader.am.utils import AsrDataset, AsrDataLoader, collate_egs
 from aps.loader.audio import AudioReader
-from aps.const import IGNORE_ID
 from aps.libs import ApsRegisters
 
 
@@ -34,7 +30,8 @@ def DataLoader(train: bool = True,
                batch_mode: str = "adaptive",
                num_workers: int = 0,
                max_batch_size: int = 32,
-               min_batch_size: int = 4) -> Iterable[Dict]:
+               min_batch_size: int = 4,
+               prefetch: int = 0) -> Iterable[Dict]:
     """
     Return the raw waveform dataloader (for AM training)
     Args:
@@ -54,6 +51,7 @@ def DataLoader(train: bool = True,
         num_workers: number of the workers
         max_batch_size: maximum #batch_size
         min_batch_size: minimum #batch_size
+        prefetch: number of the batches prefetched in a background thread when num_workers == 0
     """
     dataset = Dataset(wav_scp,
                       text,
@@ -75,7 +73,8 @@ def DataLoader(train: bool = True,
                          adapt_token_num=adapt_token_num,
                          batch_mode=batch_mode,
                          max_batch_size=max_batch_size,
-                         min_batch_size=min_batch_size)
+                         min_batch_size=min_batch_size,
+                         prefetch=prefetch)
 
 
 class Dataset(AsrDataset):
@@ -120,7 +119,7 @@ class Dataset(AsrDataset):
                                       vocab_dict,
                                       max_dur=max_wav_dur,
                                       min_dur=min_wav_dur,
-                                      dur_axis=0,
+                                      dur_axis=-1,
                                       skip_utts=skip_utts,
                                       min_token_num=min_token_num,
                                       max_token_num=max_token_num)
@@ -136,32 +135,4 @@ def egs_collate(egs: Dict) -> Dict:
         src_len: number of the frames, N
         tgt_len: length of the tokens, N
     """
-
-    def pad_seq(seq, value=0):
-        peek_dim = seq[0].dim()
-        assert peek_dim in [1, 2]
-        # C x S => S x C
-        if peek_dim == 2:
-            seq = [s.transpose(0, 1) for s in seq]
-        # N x S x C
-        pad_mat = pad_sequence(seq, batch_first=True, padding_value=value)
-        # N x (C) x S
-        if peek_dim == 2:
-            pad_mat = pad_mat.transpose(1, 2)
-        return pad_mat
-
-    egs = {
-        "#utt":
-            len(egs),
-        "#tok":  # add 1 as during training we pad sos
-            sum([int(eg["len"]) + 1 for eg in egs]),
-        "src_pad":
-            pad_seq([th.from_numpy(eg["inp"]) for eg in egs], value=0),
-        "tgt_pad":
-            pad_seq([th.as_tensor(eg["ref"]) for eg in egs], value=IGNORE_ID),
-        "src_len":
-            th.tensor([eg["dur"] for eg in egs], dtype=th.int64),
-        "tgt_len":
-            th.tensor([eg["len"] for eg in egs], dtype=th.int64)
-    }
-    return egs
+    return collate_egs(egs, time_axis=-1)
@@ -4,14 +4,17 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import warnings
+import numpy as np
 import torch as th
 
 import torch.utils.data as dat
 import aps.distributed as dist
 
-from typing import Dict, List, Tuple, NoReturn, Optional, Callable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, NoReturn, Optional, Callable, Iterator
 from kaldi_python_io import Reader as BaseReader
-from aps.const import UNK_TOKEN
+from aps.const import UNK_TOKEN, IGNORE_ID
 
 
 def derive_indices(num_batches: int,
@@ -37,6 +40,69 @@ def derive_indices(num_batches: int,
         return indices
 
 
+def collate_egs(egs: List[Dict], time_axis: int = 0) -> Dict:
+    """
+    Shared batch collate function of the AM dataloaders. The padded tensors
+    are allocated once without initialization, then each utterance is copied
+    into it (numpy views, C-level copy) and only the padding part is zeroed.
+    Lengths and labels are kept in int32 to halve the host->device copy,
+    they are widened to int64 in the task (on device)
+    Args:
+        egs: list of the examples from AsrDataset
+        time_axis: time axis of the inputs (to pad along)
+    """
+    src_len = th.tensor([eg["dur"] for eg in egs], dtype=th.int32)
+    tgt_len = th.tensor([eg["len"] for eg in egs], dtype=th.int32)
+    inp_shape = list(egs[0]["inp"].shape)
+    inp_shape[time_axis] = src_len.max().item()
+    src_pad = th.empty([len(egs)] + inp_shape, dtype=th.float32)
+    tgt_pad = th.full((len(egs), tgt_len.max().item()),
+                      IGNORE_ID,
+                      dtype=th.int32)
+    # N x T x ...
+    src_buf = np.moveaxis(src_pad.numpy(), time_axis % len(inp_shape) + 1, 1)
+    tgt_buf = tgt_pad.numpy()
+    for i, eg in enumerate(egs):
+        src_buf[i, :eg["dur"]] = np.moveaxis(eg["inp"], time_axis, 0)
+        src_buf[i, eg["dur"]:] = 0
+        tgt_buf[i, :eg["len"]] = eg["ref"]
+    return {
+        "#utt": len(egs),
+        "#tok": (tgt_len + 1).sum().item(),  # add 1 as we pad sos in training
+        "src_pad": src_pad,
+        "tgt_pad": tgt_pad,
+        "src_len": src_len,
+        "tgt_len": tgt_len
+    }
+
+
+class TransformCollate(object):
+    """
+    Wrap the collate function and run the ASR feature transform (on CPU) in
+    the dataloader, so the feature extraction overlaps with the training
+    steps on GPU (used with precompute_features=True in the AM)
+    Args:
+        collate_fn: collate function of the AM dataloaders
+        transform: instance of the ASR feature transform
+    """
+
+    def __init__(self, collate_fn: Callable, transform: th.nn.Module) -> None:
+        # the parameters here are a copy of the ones in the AM, never updated
+        if any(p.requires_grad for p in transform.parameters()):
+            raise RuntimeError("Can't precompute features with a trainable " +
+                               "feature transform")
+        self.collate_fn = collate_fn
+        self.transform = transform
+
+    def __call__(self, egs: List[Dict]) -> Dict:
+        egs = self.collate_fn(egs)
+        with th.no_grad():
+            feats, num_frames = self.transform(egs["src_pad"], egs["src_len"])
+        egs["src_pad"] = feats.contiguous()
+        egs["src_len"] = num_frames.to(egs["src_len"].dtype)
+        return egs
+
+
 class AsrDataset(dat.Dataset):
     """
     A base dataset class for AM training
@@ -108,17 +174,16 @@ class TokenReader(object):
                  min_dur: float = 40,
                  skip_utts: str = ""):
         self.vocab_dict = vocab_dict
-        self.token_list = self._pre_process(text,
-                                            utt2dur,
-                                            max_dur=max_dur,
-                                            min_dur=min_dur,
-                                            skip_utts=skip_utts,
-                                            max_token_num=max_token_num,
-                                            min_token_num=min_token_num)
-        if len(self.token_list) < 10:
-            raise RuntimeError(
-                f"Too less utterances: {len(self.token_list)}, " +
-                "please check data configurations")
+        self._pre_process(text,
+                          utt2dur,
+                          max_dur=max_dur,
+                          min_dur=min_dur,
+                          skip_utts=skip_utts,
+                          max_token_num=max_token_num,
+                          min_token_num=min_token_num)
+        if len(self) < 10:
+            raise RuntimeError(f"Too less utterances: {len(self)}, " +
+                               "please check data configurations")
 
     def _pre_process(self,
                      text: str,
@@ -127,63 +192,76 @@ class TokenReader(object):
                      min_token_num: int = 2,
                      skip_utts: str = "",
                      max_dur: float = 3000,
-                     min_dur: float = 40) -> List[Dict]:
+                     min_dur: float = 40) -> NoReturn:
         """
-        Preprocess function to filter the utterances
+        Preprocess function to filter the utterances. The results are kept
+        in columnar arrays, sorted by duration and then number of the tokens
+        (long -> short), so each batch is a run of utterances with similar
+        input/output lengths:
+            self.keys: utterance keys
+            self.dur: durations of the utterances
+            self.len: number of the tokens
+            self.tok|self.offset: token sequences, concatenated (int ids)
         """
         if skip_utts:
             with open(skip_utts, "r") as skip_fd:
-                skip_keys = [k.strip() for k in skip_fd.readlines()]
+                skip_keys = set([k.strip() for k in skip_fd.readlines()])
         else:
-            skip_keys = []
+            skip_keys = set()
         utt2dur = BaseReader(utt2dur, value_processor=float)
-        if self.vocab_dict:
-            text_reader = BaseReader(text, num_tokens=-1, restrict=False)
-        else:
-            text_reader = BaseReader(
-                text,
-                value_processor=lambda tok: list(map(int, tok)),
-                num_tokens=-1,
-                restrict=False)
-        token_set = []
-        drop_utts = 0
+        text_reader = BaseReader(text, num_tokens=-1, restrict=False)
+        keys, toks = [], []
         for key, tokens in text_reader:
-            num_toks = len(tokens)
-            if num_toks > max_token_num or num_toks < min_token_num:
-                drop_utts += 1
-                continue
-            if key not in utt2dur:
-                drop_utts += 1
-                continue
             if key in skip_keys:
                 continue
-            num_frames = utt2dur[key]
-            if num_frames < min_dur or num_frames > max_dur:
-                drop_utts += 1
-                continue
-            token_set.append({
-                "key": key,
-                "dur": num_frames,
-                "len": num_toks,
-                "tok": tokens
-            })
-        # long -> short
-        token_set = sorted(token_set, key=lambda d: d["dur"], reverse=True)
+            keys.append(key)
+            toks.append(tokens)
+        num_toks = np.array([len(t) for t in toks], dtype=np.int64)
+        # NaN if missing in utt2dur
+        dur = np.array([utt2dur[k] if k in utt2dur else np.nan for k in keys],
+                       dtype=np.float64)
+        with np.errstate(invalid="ignore"):
+            keep = np.logical_and.reduce([
+                num_toks >= min_token_num, num_toks <= max_token_num,
+                dur >= min_dur, dur <= max_dur
+            ])
+        index = np.nonzero(keep)[0]
+        # long -> short, ties broken by #tokens to reduce target padding
+        index = index[np.lexsort((-num_toks[index], -dur[index]))]
+        self.keys = [keys[i] for i in index]
+        self.dur = dur[index]
+        self.len = num_toks[index]
+        self.offset = np.zeros(index.size + 1, dtype=np.int64)
+        np.cumsum(self.len, out=self.offset[1:])
+        # tokenize: string tokens => int sequences
+        if self.vocab_dict:
+            unk = self.vocab_dict.get(UNK_TOKEN, None)
+
+            def tokenize(t):
+                if t in self.vocab_dict:
+                    return self.vocab_dict[t]
+                if unk is None:
+                    raise KeyError(f"{t} and {UNK_TOKEN} not in dictionary")
+                return unk
+        else:
+            tokenize = int
+        self.tok = np.array([tokenize(t) for i in index for t in toks[i]],
+                            dtype=np.int64)
+        drop_utts = len(keys) - index.size
         if drop_utts:
             warnings.warn(f"Drop {drop_utts} utterances")
-        return token_set
 
-    def __getitem__(self, index):
-        stats = self.token_list[index]
-        # if processed, skip
-        if self.vocab_dict and "vis" not in stats:
-            stats["tok"] = [(self.vocab_dict[t] if t in self.vocab_dict else
-                             self.vocab_dict[UNK_TOKEN]) for t in stats["tok"]]
-            stats["vis"] = True
-        return stats
+    def __getitem__(self, index: int) -> Dict:
+        beg, end = self.offset[index], self.offset[index + 1]
+        return {
+            "key": self.keys[index],
+            "dur": self.dur[index],
+            "len": int(self.len[index]),
+            "tok": self.tok[beg:end]
+        }
 
     def __len__(self) -> int:
-        return len(self.token_list)
+        return len(self.keys)
 
 
 class BatchSampler(dat.Sampler):
@@ -193,7 +271,8 @@ class BatchSampler(dat.Sampler):
         dataset: dataset object
         max_batch_size: maximum #batch_size
         min_batch_size: minimum #batch_size
-        shuffle: shuffle batches or not
+        shuffle: shuffle batches or not (only the order of the batches is
+                 shuffled, each batch is a sorted span of the dataset)
         batch_mode: "adaptive" or "constraint"
         adapt_dur|adapt_token_num: used in adaptive mode, see _work_adapt_batch_index
         distributed: distributed or not
@@ -235,13 +314,12 @@ class BatchSampler(dat.Sampler):
         cur_dur = 0
         idx_bz = []
         # long -> short
+        utts_dur = dataset.token_reader.dur
+        if tot and utts_dur[0] > max_batch_size:
+            raise ValueError("batch_size is smaller than maximum "
+                             "length of the utterances")
         for idx in range(tot):
-            cur = dataset.token_reader[idx]
-            if idx == 0:
-                if cur["dur"] > max_batch_size:
-                    raise ValueError("batch_size is smaller than maximum "
-                                     "length of the utterances")
-            utt_dur = cur["dur"]
+            utt_dur = utts_dur[idx]
             if cur_dur < max_batch_size:
                 cur_dur += utt_dur
             else:
@@ -265,10 +343,11 @@ class BatchSampler(dat.Sampler):
         tot = len(dataset)
         cur_bz = max_batch_size
         idx_boundary = []
+        utts_dur = dataset.token_reader.dur
+        utts_len = dataset.token_reader.len
         while beg < tot:
-            cur = dataset.token_reader[beg]
-            cur_ilen = cur["dur"]
-            cur_olen = cur["len"]
+            cur_ilen = utts_dur[beg]
+            cur_olen = utts_len[beg]
             factor = max(cur_ilen // adapt_dur, (cur_olen - 1) // adapt_num)
             cur_bz = int(max(min_batch_size, max_batch_size // (1 + factor)))
             idx_boundary.append((beg, min(beg + cur_bz, tot)))
@@ -304,6 +383,11 @@ class AsrDataLoader(dat.DataLoader):
         batch_mode: adaptive or constraint
         max_batch_size: maximum #batch_size
         min_batch_size: minimum #batch_size
+        pin_memory: copy batches into pinned memory (if cuda is available)
+        prefetch: number of batches loaded in a background thread ahead of
+                  time when num_workers == 0 (0 to disable). NOTE: the
+                  random augmentation in collate_fn then draws from the
+                  global RNG on that thread, which breaks reproducibility
     """
 
     def __init__(self,
@@ -316,7 +400,10 @@ class AsrDataLoader(dat.DataLoader):
                  adapt_token_num: int = 150,
                  batch_mode: str = "adaptive",
                  max_batch_size: int = 32,
-                 min_batch_size: int = 4) -> None:
+                 min_batch_size: int = 4,
+                 pin_memory: bool = False,
+                 prefetch: int = 0) -> None:
+        self.prefetch = prefetch
         sampler = BatchSampler(dataset,
                                max_batch_size,
                                shuffle=shuffle,
@@ -325,10 +412,38 @@ class AsrDataLoader(dat.DataLoader):
                                distributed=distributed,
                                min_batch_size=min_batch_size,
                                adapt_token_num=adapt_token_num)
+        pin_memory = pin_memory and th.cuda.is_available()
         super(AsrDataLoader, self).__init__(dataset,
                                             collate_fn=collate_fn,
                                             num_workers=num_workers,
+                                            pin_memory=pin_memory,
                                             batch_sampler=sampler)
 
+    def __iter__(self) -> Iterator[Dict]:
+        base_iter = super(AsrDataLoader, self).__iter__()
+        if self.num_workers or self.prefetch <= 0:
+            return base_iter
+        return prefetch_iter(base_iter, self.prefetch)
+
     def set_epoch(self, epoch: int) -> NoReturn:
         self.batch_sampler.set_epoch(epoch)
+
+
+def prefetch_iter(base_iter: Iterator, prefetch: int) -> Iterator:
+    """
+    Load the next #prefetch batches in a background thread, so the feature
+    reading overlaps with the computation of the current batch. One thread
+    is used as the readers (e.g., kaldi's ScriptReader) share file handles
+    Args:
+        base_iter: iterator of the single-process dataloader
+        prefetch: number of the prefetched batches
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        queue = deque(
+            [pool.submit(next, base_iter, None) for _ in range(prefetch)])
+        while True:
+            egs = queue.popleft().result()
+            if egs is None:
+                break
+            queue.append(pool.submit(next, base_iter, None))
+            yield egs
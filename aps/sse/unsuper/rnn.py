@@ -7,7 +7,7 @@ import numpy as np
 import torch as th
 import torch.nn as nn
 
-from typing import Union, Optional
+from typing import Union, Optional, Tuple
 from aps.asr.base.encoder import PyTorchRNNEncoder
 from aps.sse.base import SseBase
 from aps.const import EPSILON
@@ -121,8 +121,8 @@ class RNNEnhML(SseBase):
         """
         self.check_args(noisy, training=False, valid_dim=[2])
         with th.no_grad():
-            noisy = noisy[None, ...]
-            _, masks = self.forward(noisy)
+            # only masks are required here, skip the STFT normalization
+            _, masks = self._forward(noisy[None, ...])
             return masks[0]
 
     def _norm_abs(self, obs: ComplexTensor) -> ComplexTensor:
@@ -135,7 +135,7 @@ class RNNEnhML(SseBase):
         obs = ComplexTensor(mag, obs.angle(), polar=True)
         return obs
 
-    def forward(self, noisy: th.Tensor) -> Union[ComplexTensor, th.Tensor]:
+    def _forward(self, noisy: th.Tensor) -> Tuple[ComplexTensor, th.Tensor]:
         """
         Args
             noisy: N x C x S
@@ -143,10 +143,20 @@ class RNNEnhML(SseBase):
             cstft (ComplexTensor): N x C x F x T
             masks (Tensor): N x T x F
         """
-        self.check_args(noisy, training=True, valid_dim=[3])
         # feats: N x T x F
         # cspec: N x C x F x T
         feats, cstft, _ = self.enh_transform(noisy, None)
-        cstft = self._norm_abs(cstft)
         masks, _ = self.base_rnn(feats, None)
         return cstft, masks
+
+    def forward(self, noisy: th.Tensor) -> Union[ComplexTensor, th.Tensor]:
+        """
+        Args
+            noisy: N x C x S
+        Return
+            cstft (ComplexTensor): N x C x F x T
+            masks (Tensor): N x T x F
+        """
+        self.check_args(noisy, training=True, valid_dim=[3])
+        cstft, masks = self._forward(noisy)
+        return self._norm_abs(cstft), masks
@@ -52,6 +52,16 @@ def compute_accu(outs: th.Tensor, tgts: th.Tensor) -> Tuple[float]:
     return (accu.item(), total.item())
 
 
+def widen_asr_egs(egs: Dict) -> Dict:
+    """
+    The AM dataloader keeps lengths & labels in int32 (smaller host->device
+    copy), widen them to int64 (required for indexing and embedding)
+    """
+    for key in ["src_len", "tgt_pad", "tgt_len"]:
+        egs[key] = egs[key].long()
+    return egs
+
+
 def prep_asr_label(
         tgt_pad: th.Tensor,
         tgt_len: th.Tensor,
@@ -148,6 +158,7 @@ class CtcXentHybridTask(Task):
             tgt_len: N
             ssr (float): const if needed
         """
+        egs = widen_asr_egs(egs)
         # tgt_pad: N x To (replace ignore_id with eos, used in decoder)
         # tgts: N x To+1 (pad eos, used in loss)
         tgt_pad, tgts = prep_asr_label(egs["tgt_pad"],
@@ -246,6 +257,7 @@ class TransducerTask(Task):
             tgt_pad: N x To
             tgt_len: N
         """
+        egs = widen_asr_egs(egs)
         # tgt_pad: N x To (replace ignore_id with blank)
         tgt_pad, _ = prep_asr_label(egs["tgt_pad"],
                                     egs["tgt_len"],
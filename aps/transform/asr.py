@@ -19,15 +19,18 @@ import torch.nn as nn
 import torch.nn.functional as tf
 
 from typing import Optional, Union, Tuple
-from aps.transform.utils import STFT, mel_filter, splice_feature, speed_perturb_filter
-from aps.transform.augment import tf_mask, perturb_speed
+from aps.transform.utils import STFT, mel_filter, dct_matrix, splice_feature, speed_perturb_filter
+from aps.transform.augment import tf_bands, perturb_speed
 from aps.const import EPSILON, MAX_INT16
 from aps.libs import ApsRegisters
 from aps.cplx import ComplexTensor
+from aps.utils import bf16_supported, compiled
 
-from scipy.fftpack import dct as scipy_dct
 from kaldi_python_io.functional import read_kaldi_mat
 
+# align the dimensions of the bfloat16 projections to the tensor core tiles
+TC_ALIGN = 16
+
 AsrReturnType = Union[th.Tensor, Optional[th.Tensor]]
 
 
@@ -54,6 +57,49 @@ def check_valid(feature: th.Tensor,
     return feature, num_frames
 
 
+@th.jit.script
+def linear_last(feats: th.Tensor, weight: th.Tensor) -> th.Tensor:
+    """
+    tf.linear(feats, weight) without bias. If feats is the transposed view of
+    a contiguous ... x K x T tensor (e.g., after TFTransposeTransform), do the
+    GEMM in that layout (weight @ feats^T) so that the large input is not
+    copied into a contiguous one when folding the batch dimensions
+    """
+    # ... x K x T
+    feats_t = feats.transpose(-1, -2)
+    if feats.dim() > 2 and feats_t.is_contiguous():
+        # ... x M x T => ... x T x M
+        proj = th.matmul(weight, feats_t).transpose(-1, -2)
+        return proj.contiguous()
+    return tf.linear(feats, weight)
+
+
+def project(feats: th.Tensor,
+            weight: th.Tensor,
+            bf16: bool = False) -> th.Tensor:
+    """
+    Linear projection (mel filters, DCT) on the last dimension. If bf16 is
+    true and supported on the device, do it in bfloat16 (tensor cores) and
+    cast the results back to float32
+    """
+    if bf16 and bf16_supported(feats):
+        M, K = weight.shape
+        # zero pad M & K (e.g., 257 bins) to the multiple of the tensor core
+        # tile size when casting, so that cuBLAS does not fall back to the
+        # slow kernels for unaligned shapes. Buffers are padded here (not the
+        # stored weights) to keep the state_dict unchanged
+        pad_m, pad_k = [
+            (d + TC_ALIGN - 1) // TC_ALIGN * TC_ALIGN for d in (M, K)
+        ]
+        inp = feats.new_empty(feats.shape[:-1] + (pad_k,), dtype=th.bfloat16)
+        inp[..., :K] = feats
+        inp[..., K:] = 0
+        mat = weight.new_zeros(pad_m, pad_k, dtype=th.bfloat16)
+        mat[:M, :K] = weight
+        return tf.linear(inp, mat, bias=None)[..., :M].to(th.float32)
+    return linear_last(feats, weight)
+
+
 class RescaleTransform(nn.Module):
     """
     Rescale audio samples (e.g., [-1, 1] to MAX_INT16 scale)
@@ -266,11 +312,11 @@ class SpectrogramTransform(STFT):
         Return:
             mag (Tensor): magnitude, N x (C) x F x T
         """
-        # N x (C) x F x T
-        mag, _ = super().forward(wav)
-        if self.use_power:
-            mag = mag**2
-        return mag
+        # N x (C) x F x T (skip the phase)
+        real, imag = super().forward(wav, output="complex")
+        # same as mag**2 with mag from STFT (polar)
+        power = real**2 + imag**2 + EPSILON
+        return power if self.use_power else power**0.5
 
 
 class AbsTransform(nn.Module):
@@ -294,9 +340,11 @@ class AbsTransform(nn.Module):
         Return:
             tensor (Tensor): N x T x F
         """
-        if not isinstance(tensor, th.Tensor):
-            tensor = tensor + self.eps
-        return tensor.abs()
+        if isinstance(tensor, th.Tensor):
+            return tensor.abs()
+        # |tensor + eps|, accumulated in place on one real buffer
+        mag = (tensor.real + self.eps)**2
+        return mag.addcmul_(tensor.imag, tensor.imag).sqrt_()
 
 
 class PowerTransform(nn.Module):
@@ -329,6 +377,7 @@ class MelTransform(nn.Module):
         fmax: highest frequency (in Hz)
         mel_filter: if not "", load mel filter from this
         requires_grad: make it trainable or not
+        bf16: multiply mel filters in bfloat16 (if supported)
     """
 
     def __init__(self,
@@ -340,7 +389,8 @@ class MelTransform(nn.Module):
                  fmax: Optional[float] = None,
                  mel_matrix: str = "",
                  coeff_norm: bool = False,
-                 requires_grad: bool = False) -> None:
+                 requires_grad: bool = False,
+                 bf16: bool = False) -> None:
         super(MelTransform, self).__init__()
         if mel_matrix:
             # pass existed tensor for initialization
@@ -361,6 +411,7 @@ class MelTransform(nn.Module):
         self.fmin = fmin
         self.fmax = sr // 2 if fmax is None else fmax
         self.init = mel_matrix if mel_matrix else "librosa"
+        self.bf16 = bf16
 
     def dim(self) -> int:
         return self.num_mels
@@ -368,7 +419,8 @@ class MelTransform(nn.Module):
     def extra_repr(self) -> str:
         shape = self.filters.shape
         return (f"fmin={self.fmin}, fmax={self.fmax}, " +
-                f"mel_filter={shape[0]}x{shape[1]}, init={self.init}")
+                f"mel_filter={shape[0]}x{shape[1]}, init={self.init}, " +
+                f"bf16={self.bf16}")
 
     def forward(self, linear: th.Tensor) -> th.Tensor:
         """
@@ -381,10 +433,22 @@ class MelTransform(nn.Module):
             raise RuntimeError("MelTransform expect 3/4D tensor, " +
                                f"but got {linear.dim()} instead")
         # N x T x F => N x T x M
-        fbank = tf.linear(linear, self.filters, bias=None)
+        fbank = project(linear, self.filters, bf16=self.bf16)
         return fbank
 
 
+@th.jit.script
+def floor_log(linear: th.Tensor, eps: float, lower_bound: float) -> th.Tensor:
+    """
+    log(max(x, eps)) or log(x + lower_bound), scripted so that the element-wise
+    ops can be fused into one kernel
+    """
+    if lower_bound > 0:
+        return th.log(linear + lower_bound)
+    else:
+        return th.log(th.clamp_min(linear, eps))
+
+
 class LogTransform(nn.Module):
     """
     Transform feature from linear domain to log domain
@@ -411,11 +475,7 @@ class LogTransform(nn.Module):
         Return:
             logf (Tensor): log features, N x (C) x T x F
         """
-        if self.lower_bound > 0:
-            linear = self.lower_bound + linear
-        else:
-            linear = th.clamp(linear, min=self.eps)
-        return th.log(linear)
+        return floor_log(linear, float(self.eps), float(self.lower_bound))
 
 
 class DiscreteCosineTransform(nn.Module):
@@ -425,21 +485,22 @@ class DiscreteCosineTransform(nn.Module):
         num_ceps: number of the cepstrum coefficients
         num_mels: number of mel bands
         lifter: lifter factor
+        bf16: multiply DCT matrix in bfloat16 (if supported)
     """
 
     def __init__(self,
                  num_ceps: int = 13,
                  num_mels: int = 40,
-                 lifter: float = 0) -> None:
+                 lifter: float = 0,
+                 bf16: bool = False) -> None:
         super(DiscreteCosineTransform, self).__init__()
+        self.bf16 = bf16
         self.lifter = lifter
         self.num_ceps = num_ceps
-        # num_mels x num_ceps
-        dct_mat = scipy_dct(th.eye(num_mels).numpy(),
-                            norm="ortho")[:, :num_ceps]
         # num_ceps x num_mels
         # NOTE: DCT matrix is compatiable with kaldi
-        self.dct = nn.Parameter(th.from_numpy(dct_mat.T), requires_grad=False)
+        self.dct = nn.Parameter(dct_matrix(num_ceps, num_mels),
+                                requires_grad=False)
         if lifter > 0:
             cepstral_lifter = 1 + lifter * 0.5 * th.sin(
                 math.pi * th.arange(1, 1 + num_ceps) / lifter)
@@ -452,8 +513,8 @@ class DiscreteCosineTransform(nn.Module):
         return self.num_ceps
 
     def extra_repr(self) -> str:
-        return "cepstral_lifter={0}, dct={1[0]}x{1[1]}".format(
-            self.lifter, self.dct.shape)
+        return "cepstral_lifter={0}, dct={1[0]}x{1[1]}, bf16={2}".format(
+            self.lifter, self.dct.shape, self.bf16)
 
     def forward(self, log_mel: th.Tensor) -> th.Tensor:
         """
@@ -462,10 +523,49 @@ class DiscreteCosineTransform(nn.Module):
         Return:
             mfcc (Tensor): mfcc feature, N x (C) x T x P
         """
-        mfcc = tf.linear(log_mel, self.dct, bias=None)
-        if self.cepstral_lifter is not None:
-            mfcc = mfcc * self.cepstral_lifter
-        return mfcc
+        return project(log_mel, self.weight(), bf16=self.bf16)
+
+    def weight(self) -> th.Tensor:
+        """
+        Return DCT matrix with the cepstral lifter folded in, num_ceps x num_mels
+        """
+        if self.cepstral_lifter is None:
+            return self.dct
+        return self.dct * self.cepstral_lifter[:, None]
+
+
+@th.jit.script
+def cmvn(feats: th.Tensor,
+         norm_mean: bool,
+         norm_var: bool,
+         per_band: bool,
+         eps: float,
+         gmean: Optional[th.Tensor] = None,
+         gstd: Optional[th.Tensor] = None) -> th.Tensor:
+    """
+    Mean & variance normalization (utterance level or global if gmean/gstd
+    are given), see CmvnTransform
+    """
+    if not norm_mean and not norm_var:
+        return feats
+    axis = [-2] if per_band else [-1, -2]
+    if not norm_var:
+        if gmean is not None:
+            mean = gmean
+        else:
+            mean = th.mean(feats, axis, keepdim=True)
+        return feats - mean
+    if gmean is not None and gstd is not None:
+        mean = gmean
+        scale = th.reciprocal(gstd)
+    else:
+        # one reduction pass for both statistics
+        var, mean = th.var_mean(feats, axis, unbiased=False, keepdim=True)
+        scale = th.rsqrt(var + eps)
+    if not norm_mean:
+        return feats * scale
+    # (feats - mean) * scale in one pass
+    return th.addcmul(-mean * scale, feats, scale)
 
 
 class CmvnTransform(nn.Module):
@@ -521,24 +621,13 @@ class CmvnTransform(nn.Module):
         Return:
             feats (Tensor): normalized feature, N x (C) x T x F
         """
-        if not self.norm_mean and not self.norm_var:
-            return feats
-        if self.gmean is not None:
-            if self.norm_mean:
-                feats = feats - self.gmean
-            if self.norm_var:
-                feats = feats / self.gstd
-        else:
-            axis = -2 if self.per_band else (-1, -2)
-            if self.norm_mean:
-                feats = feats - th.mean(feats, axis, keepdim=True)
-            if self.norm_var:
-                if self.norm_mean:
-                    var = th.mean(feats**2, axis, keepdim=True)
-                else:
-                    var = th.var(feats, axis, unbiased=False, keepdim=True)
-                feats = feats / th.sqrt(var + self.eps)
-        return feats
+        return cmvn(feats,
+                    self.norm_mean,
+                    self.norm_var,
+                    self.per_band,
+                    self.eps,
+                    gmean=self.gmean,
+                    gstd=self.gstd)
 
 
 class SpecAugTransform(nn.Module):
@@ -574,6 +663,32 @@ class SpecAugTransform(nn.Module):
             f"p={self.p}, p_time={self.p_time}, mask_zero={self.mask_zero}, "
             f"num_freq_masks={self.fnum}, num_time_masks={self.tnum}")
 
+    @compiled
+    def _augment(self, x: th.Tensor) -> th.Tensor:
+        """
+        Generate & apply the TF masks (for the whole batch)
+        """
+        if x.dim() == 4:
+            N, _, T, F = x.shape
+        else:
+            N, T, F = x.shape
+        # N x F, N x T
+        fmask, tmask = tf_bands(N, (T, F),
+                                p=self.p_time,
+                                max_bands=self.F,
+                                max_frame=self.T,
+                                num_freq_masks=self.fnum,
+                                num_time_masks=self.tnum,
+                                device=x.device)
+        if x.dim() == 4:
+            # N x 1 x F, N x 1 x T
+            fmask, tmask = fmask[:, None], tmask[:, None]
+        value = 0 if self.mask_zero else x.mean()
+        # fill the broadcasted band masks into one output tensor, without
+        # the N x T x F mask and the multiplication
+        x = x.masked_fill(fmask[..., None, :], value)
+        return x.masked_fill_(tmask[..., None], value)
+
     def forward(self, x: th.Tensor) -> th.Tensor:
         """
         Args:
@@ -582,25 +697,7 @@ class SpecAugTransform(nn.Module):
             y (Tensor): augmented features
         """
         if self.training and th.rand(1).item() < self.p:
-            if x.dim() == 4:
-                N, _, T, F = x.shape
-            else:
-                N, T, F = x.shape
-            # N x T x F
-            mask = tf_mask(N, (T, F),
-                           p=self.p_time,
-                           max_bands=self.F,
-                           max_frame=self.T,
-                           num_freq_masks=self.fnum,
-                           num_time_masks=self.tnum,
-                           device=x.device)
-            if x.dim() == 4:
-                # N x 1 x T x F
-                mask = mask.unsqueeze(1)
-            if self.mask_zero:
-                x = x * mask
-            else:
-                x = th.masked_fill(x, mask == 0, x.mean())
+            x = self._augment(x)
         return x
 
 
@@ -636,14 +733,18 @@ class SpliceTransform(nn.Module):
         return:
             slice (Tensor): spliced feature, N x ... x To x FD
         """
-        # N x ... x T x FD
+        if self.lctx + self.rctx == 0:
+            return feats[..., ::self.subsampling_factor, :]
+        # N x ... x T x F x D (view)
         feats = splice_feature(feats,
                                lctx=self.lctx,
                                rctx=self.rctx,
-                               subsampling_factor=self.subsampling_factor)
-        if self.subsampling_factor != 1:
-            feats = feats[..., ::self.subsampling_factor, :]
-        return feats
+                               subsampling_factor=self.subsampling_factor,
+                               op="stack")
+        # subsampling before the copy: N x ... x To x F x D
+        feats = feats[..., ::self.subsampling_factor, :, :]
+        # N x ... x To x DF
+        return feats.transpose(-1, -2).reshape(feats.shape[:-2] + (-1,))
 
 
 class DeltaTransform(nn.Module):
@@ -663,6 +764,7 @@ class DeltaTransform(nn.Module):
         self.order = order
         scale = th.arange(-ctx, ctx + 1, dtype=th.float32)
         normalizer = sum(i * i for i in range(-ctx, ctx + 1))
+        # FIR kernel of the delta (applied by conv1d)
         self.scale = nn.Parameter(scale / normalizer, requires_grad=False)
         self.delta_as_channel = delta_as_channel
 
@@ -672,6 +774,17 @@ class DeltaTransform(nn.Module):
     def dim_scale(self) -> int:
         return self.order
 
+    def _delta(self, inp: th.Tensor) -> th.Tensor:
+        """
+        Compute delta as one conv1d along the time axis (edges replicated)
+        Args:
+            inp (Tensor): N*...*F x 1 x T
+        Return:
+            delta (Tensor): N*...*F x 1 x T
+        """
+        inp = tf.pad(inp, (self.ctx, self.ctx), mode="replicate")
+        return tf.conv1d(inp, self.scale[None, None])
+
     def forward(self, feats: th.Tensor) -> th.Tensor:
         """
         args:
@@ -679,15 +792,14 @@ class DeltaTransform(nn.Module):
         return:
             delta (Tensor): delta feature, N x (C) x T x FD
         """
+        shape = feats.shape
+        T, F = shape[-2:]
+        # stay in the conv1d layout across the delta orders: N*...*F x 1 x T
+        inp = feats.reshape(-1, T, F).transpose(1, 2).reshape(-1, 1, T)
         delta = [feats]
         for _ in range(self.order):
-            # N x T x F x (2C+1)
-            splice = splice_feature(delta[-1],
-                                    lctx=self.ctx,
-                                    rctx=self.ctx,
-                                    op="stack")
-            # N x T x F
-            delta.append(th.sum(splice * self.scale, -1))
+            inp = self._delta(inp)
+            delta.append(inp.view(-1, F, T).transpose(1, 2).reshape(shape))
         if self.delta_as_channel:
             # N x C x T x F
             return th.stack(delta, 1)
@@ -696,6 +808,32 @@ class DeltaTransform(nn.Module):
             return th.cat(delta, -1)
 
 
+@th.jit.script
+def mel_log_cmvn(linear: th.Tensor,
+                 filters: th.Tensor,
+                 log_eps: float,
+                 log_lower_bound: float,
+                 norm_mean: bool,
+                 norm_var: bool,
+                 per_band: bool,
+                 cmvn_eps: float,
+                 gmean: Optional[th.Tensor] = None,
+                 gstd: Optional[th.Tensor] = None) -> th.Tensor:
+    """
+    MelTransform => LogTransform => CmvnTransform in one scripted graph, so
+    that the element-wise ops of log & cmvn can be fused
+    """
+    fbank = linear_last(linear, filters)
+    feats = floor_log(fbank, log_eps, log_lower_bound)
+    return cmvn(feats,
+                norm_mean,
+                norm_var,
+                per_band,
+                cmvn_eps,
+                gmean=gmean,
+                gstd=gstd)
+
+
 @ApsRegisters.transform.register("asr")
 class FeatureTransform(nn.Module):
     """
@@ -746,6 +884,8 @@ class FeatureTransform(nn.Module):
         lctx|rctx: left/right context for splicing (splice)
         delta_ctx|delta_order: context|order used in delta feature (delta)
         requires_grad: make mel matrice trainable
+        bf16_matmul: do mel & dct projection in bfloat16 (if supported, cmvn
+                     and other parts are still in float32)
         eps: floor number
     """
 
@@ -787,6 +927,7 @@ class FeatureTransform(nn.Module):
                  delta_order: int = 2,
                  delta_as_channel: bool = False,
                  requires_grad: bool = False,
+                 bf16_matmul: bool = False,
                  eps: float = EPSILON) -> None:
         super(FeatureTransform, self).__init__()
         if not feats:
@@ -811,7 +952,14 @@ class FeatureTransform(nn.Module):
             "num_mels": num_mels,
             "coeff_norm": mel_coeff_norm,
             "mel_matrix": mel_matrix,
-            "requires_grad": requires_grad
+            "requires_grad": requires_grad,
+            "bf16": bf16_matmul
+        }
+        dct_kwargs = {
+            "num_ceps": num_ceps,
+            "num_mels": num_mels,
+            "lifter": lifter,
+            "bf16": bf16_matmul
         }
         self.spectra_index = -1
         self.perturb_index = -1
@@ -851,9 +999,7 @@ class FeatureTransform(nn.Module):
                     TFTransposeTransform(),
                     MelTransform(frame_len, **mel_kwargs),
                     LogTransform(eps=eps),
-                    DiscreteCosineTransform(num_ceps=num_ceps,
-                                            num_mels=num_mels,
-                                            lifter=lifter)
+                    DiscreteCosineTransform(**dct_kwargs)
                 ]
                 transform += mfcc
                 feats_dim = transform[-1].dim()
@@ -866,10 +1012,7 @@ class FeatureTransform(nn.Module):
             elif tok == "abs":
                 transform.append(AbsTransform(eps=eps))
             elif tok == "dct":
-                transform.append(
-                    DiscreteCosineTransform(num_ceps=num_ceps,
-                                            num_mels=num_mels,
-                                            lifter=lifter))
+                transform.append(DiscreteCosineTransform(**dct_kwargs))
                 feats_dim = transform[-1].dim()
             elif tok == "cmvn":
                 transform.append(
@@ -902,6 +1045,65 @@ class FeatureTransform(nn.Module):
         self.transform = nn.Sequential(*transform)
         self.feats_dim = feats_dim
         self.subsampling_factor = subsampling_factor
+        self.fused_index = self._find_layers(
+            (MelTransform, LogTransform, CmvnTransform))
+        self.folded_index = self._find_layers(
+            (MelTransform, DiscreteCosineTransform))
+
+    def _find_layers(self, types: Tuple[type]) -> int:
+        """
+        Return the index of the first subsequence of the given layer types,
+        -1 if not found (or in bfloat16 projection mode)
+        """
+        for i in range(len(self.transform) - len(types) + 1):
+            if all(
+                    isinstance(self.transform[i + j], t)
+                    for j, t in enumerate(types)):
+                if not self.transform[i].bf16:
+                    return i
+        return -1
+
+    def _forward_fused(self, feats: th.Tensor) -> th.Tensor:
+        """
+        Same as self.transform(feats) but
+            1) Mel => Log => Cmvn runs fused (see mel_log_cmvn)
+            2) Mel => DCT (no log between) is folded into one projection
+        """
+        i = 0
+        while i < len(self.transform):
+            if i == self.fused_index:
+                mel, log, norm = self.transform[i:i + 3]
+                feats = mel_log_cmvn(feats,
+                                     mel.filters,
+                                     float(log.eps),
+                                     float(log.lower_bound),
+                                     norm.norm_mean,
+                                     norm.norm_var,
+                                     norm.per_band,
+                                     float(norm.eps),
+                                     gmean=norm.gmean,
+                                     gstd=norm.gstd)
+                i += 3
+            elif i == self.folded_index:
+                mel, dct = self.transform[i:i + 2]
+                # num_ceps x num_bins
+                weight = th.matmul(dct.weight(), mel.filters)
+                feats = linear_last(feats, weight)
+                i += 2
+            else:
+                feats = self.transform[i](feats)
+                i += 1
+        return feats
+
+    @compiled
+    def _extract(self, inp_pad: th.Tensor) -> th.Tensor:
+        """
+        Run the transform layers on the input
+        """
+        if self.fused_index >= 0 or self.folded_index >= 0:
+            return self._forward_fused(inp_pad)
+        else:
+            return self.transform(inp_pad)
 
     def num_frames(self, inp_len: th.Tensor) -> th.Tensor:
         """
@@ -928,6 +1130,6 @@ class FeatureTransform(nn.Module):
             feats (Tensor): acoustic features: N x C x T x ...
             num_frames (Tensor or None): number of frames
         """
-        feats = self.transform(inp_pad)
+        feats = self._extract(inp_pad)
         num_frames = self.num_frames(inp_len)
         return check_valid(feats, num_frames)
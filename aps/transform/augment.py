@@ -3,13 +3,47 @@
 # Copyright 2019 Jian Wu
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
-import random
 import torch as th
 import torch.nn.functional as tf
 
 from typing import Tuple, Union
 
 
+def tf_bands(batch: int,
+             shape: Tuple[int],
+             p: float = 1.0,
+             max_bands: int = 30,
+             max_frame: int = 40,
+             num_freq_masks: int = 2,
+             num_time_masks: int = 2,
+             device: Union[str, th.device] = "cpu") -> Tuple[th.Tensor]:
+    """
+    Return batch of frequency & time band masks (generated at once)
+    Args:
+        batch: batch size, N
+        shape: (T x F)
+    Return:
+        fmask (Tensor): bool masks (True in masked bands), N x F
+        tmask (Tensor): bool masks (True in masked frames), N x T
+    """
+    T, F = shape
+    max_frame = min(max_frame, int(T * p))
+    max_bands = min(max_bands, F)
+    # N x F
+    fmask = random_mask(batch,
+                        F,
+                        max_steps=max_bands,
+                        num_masks=num_freq_masks,
+                        device=device)
+    # N x T
+    tmask = random_mask(batch,
+                        T,
+                        max_steps=max_frame,
+                        num_masks=num_time_masks,
+                        device=device)
+    return fmask, tmask
+
+
 def tf_mask(batch: int,
             shape: Tuple[int],
             p: float = 1.0,
@@ -19,60 +53,50 @@ def tf_mask(batch: int,
             num_time_masks: int = 2,
             device: Union[str, th.device] = "cpu") -> th.Tensor:
     """
-    Return batch of TF-masks
+    Return batch of TF-masks (generated for the whole batch at once)
     Args:
         batch: batch size, N
         shape: (T x F)
     Return:
         masks (Tensor): 0,1 masks, N x T x F
     """
-    T, F = shape
-    max_frame = min(max_frame, int(T * p))
-    max_bands = min(max_bands, F)
-    mask = []
-    for _ in range(batch):
-        fmask = random_mask(shape,
-                            max_steps=max_bands,
-                            num_masks=num_freq_masks,
-                            order="freq",
+    fmask, tmask = tf_bands(batch,
+                            shape,
+                            p=p,
+                            max_bands=max_bands,
+                            max_frame=max_frame,
+                            num_freq_masks=num_freq_masks,
+                            num_time_masks=num_time_masks,
                             device=device)
-        tmask = random_mask(shape,
-                            max_steps=max_frame,
-                            num_masks=num_time_masks,
-                            order="time",
-                            device=device)
-        mask.append(fmask * tmask)
     # N x T x F
-    return th.stack(mask)
+    mask = th.logical_or(fmask[:, None], tmask[..., None])
+    return th.logical_not(mask).float()
 
 
-def random_mask(shape: Tuple[int],
+def random_mask(batch: int,
+                length: int,
                 max_steps: int = 30,
                 num_masks: int = 2,
-                order: str = "freq",
                 device: Union[str, th.device] = "cpu") -> th.Tensor:
     """
-    Generate random 0/1 masks
+    Generate random band masks along one axis
     Args:
-        shape: (T, F)
+        batch: batch size, N
+        length: length of the axis, L
     Return:
-        masks (Tensor): 0,1 masks, T x F
+        masks (Tensor): bool masks (True in masked region), N x L
     """
-    if order not in ["time", "freq"]:
-        raise RuntimeError(f"Unknown order: {order}")
-    # shape: T x F
-    masks = th.ones(shape, device=device)
-    L = shape[1] if order == "freq" else shape[0]
-    for _ in range(num_masks):
-        dur = random.randint(1, max_steps - 1)
-        if L - dur <= 0:
-            continue
-        beg = random.randint(0, L - dur - 1)
-        if order == "freq":
-            masks[:, beg:beg + dur] = 0
-        else:
-            masks[beg:beg + dur, :] = 0
-    return masks
+    if max_steps <= 1 or num_masks <= 0:
+        return th.zeros(batch, length, dtype=th.bool, device=device)
+    # N x M, dur in [1, max_steps - 1]
+    dur = th.randint(1, max_steps, (batch, num_masks), device=device)
+    # N x M, beg in [0, length - dur - 1] (skip the mask if dur >= length)
+    beg = (th.rand(batch, num_masks, device=device) * (length - dur)).long()
+    end = th.where(dur < length, beg + dur, beg)
+    # N x M x L
+    idx = th.arange(length, device=device)
+    mask = (idx >= beg[..., None]) & (idx < end[..., None])
+    return mask.any(1)
 
 
 def perturb_speed(wav: th.Tensor, weight: th.Tensor):
@@ -7,11 +7,19 @@ import numpy as np
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as tf
-import librosa.filters as filters
 
-from aps.const import EPSILON
+from functools import lru_cache
+from aps.const import EPSILON, TORCH_VERSION
+from aps.utils import compiled, inference_mode
 from typing import Optional, Union, Tuple
 
+# use FFT (torch.fft module, since 1.8) instead of conv1d in _forward_stft
+USE_FFT = TORCH_VERSION >= (1, 8)
+# round the FFT batch size (#frames) up to the multiple of it on GPU
+FFT_BATCH_ALIGN = 512
+# build complex tensors from polar coordinates with th.polar (since 1.8)
+USE_POLAR = TORCH_VERSION >= (1, 8)
+
 
 def init_window(wnd: str, frame_len: int) -> th.Tensor:
     """
@@ -43,6 +51,7 @@ def init_window(wnd: str, frame_len: int) -> th.Tensor:
     return c
 
 
+@th.no_grad()
 def init_kernel(frame_len: int,
                 frame_hop: int,
                 window: str,
@@ -64,7 +73,7 @@ def init_kernel(frame_len: int,
     if mode not in ["librosa", "kaldi"]:
         raise ValueError(f"Unsupported mode: {mode}")
     # FFT points
-    B = 2**math.ceil(math.log2(frame_len)) if round_pow_of_two else frame_len
+    B = 1 << (frame_len - 1).bit_length() if round_pow_of_two else frame_len
     # center padding window if needed
     if mode == "librosa" and B != frame_len:
         lpad = (B - frame_len) // 2
@@ -74,16 +83,18 @@ def init_kernel(frame_len: int,
         S = B**0.5
     else:
         S = 1
-    I = th.stack([th.eye(B), th.zeros(B, B)], dim=-1)
-    # W x B x 2
-    K = th.fft(I / S, 1)
-    if mode == "kaldi":
-        K = K[:frame_len]
+    # DFT basis exp(-j*2*pi*k*n/B) built directly (instead of the FFT on an
+    # identity matrix). k*n is reduced modulo B to keep the angles accurate
+    W = frame_len if mode == "kaldi" else B
+    # B x W
+    kn = th.arange(B, dtype=th.int64)[:, None] * th.arange(W, dtype=th.int64)
+    angle = (kn % B).double() * (2 * math.pi / B)
+    # 2 x B x W
+    K = th.stack([th.cos(angle), -th.sin(angle)]).float() / S
     if inverse and not normalized:
         # to make K^H * K = I
         K = K / B
-    # 2 x B x W
-    K = th.transpose(K, 0, 2) * window
+    K = K * window
     # 2B x 1 x W
     K = th.reshape(K, (B * 2, 1, K.shape[-1]))
     return K, window
@@ -110,8 +121,7 @@ def mel_filter(frame_len: int,
     """
     # FFT points
     if num_bins is None:
-        N = 2**math.ceil(
-            math.log2(frame_len)) if round_pow_of_two else frame_len
+        N = 1 << (frame_len - 1).bit_length() if round_pow_of_two else frame_len
     else:
         N = (num_bins - 1) * 2
     # fmin & fmax
@@ -121,18 +131,42 @@ def mel_filter(frame_len: int,
     else:
         fmax = min(fmax + freq_upper if fmax < 0 else fmax, freq_upper)
     fmin = max(0, fmin)
-    # mel filter coefficients
-    mel = filters.mel(sr,
-                      N,
-                      n_mels=num_mels,
-                      fmax=fmax,
-                      fmin=fmin,
-                      htk=True,
-                      norm="slaney" if norm else None)
+    # mel filter coefficients (same as librosa.filters.mel with htk=True),
+    # computed by numpy broadcasting: librosa takes ~1s to import
+    mel_min, mel_max = 2595 * np.log10(1 + np.array([fmin, fmax]) / 700)
+    # num_mels + 2
+    mel_f = 700 * (10**(np.linspace(mel_min, mel_max, num_mels + 2) / 2595) - 1)
+    # N // 2 + 1
+    fft_f = np.linspace(0, sr / 2, N // 2 + 1)
+    # (num_mels + 2) x (N // 2 + 1)
+    ramps = mel_f[:, None] - fft_f[None, :]
+    fdiff = np.diff(mel_f)[:, None]
+    lower = -ramps[:-2] / fdiff[:-1]
+    upper = ramps[2:] / fdiff[1:]
     # num_mels x (N // 2 + 1)
+    mel = np.maximum(0, np.minimum(lower, upper))
+    if norm:
+        # slaney-style normalization (constant energy per band)
+        mel *= 2.0 / (mel_f[2:, None] - mel_f[:-2, None])
     return th.tensor(mel, dtype=th.float32)
 
 
+def dct_matrix(num_ceps: int, num_mels: int) -> th.Tensor:
+    """
+    Return the orthonormal DCT-II matrix (same as kaldi), num_ceps x num_mels
+    Args:
+        num_ceps: number of the cepstrum coefficients
+        num_mels: number of mel bands
+    """
+    n = np.arange(num_mels)
+    k = np.arange(num_ceps)[:, None]
+    # closed form, instead of scipy's dct on the identity matrix
+    dct = np.cos(math.pi * (2 * n + 1) * k / (2 * num_mels))
+    dct *= math.sqrt(2 / num_mels)
+    dct[0] /= math.sqrt(2)
+    return th.tensor(dct, dtype=th.float32)
+
+
 def speed_perturb_filter(src_sr: int,
                          dst_sr: int,
                          cutoff_ratio: float = 0.95,
@@ -187,23 +221,119 @@ def splice_feature(feats: th.Tensor,
         return feats
     if op not in ["cat", "stack"]:
         raise ValueError(f"Unknown op for feature splicing: {op}")
-    # [N x ... x T x F, ...]
-    ctx = []
     T = feats.shape[-2]
     T = T - T % subsampling_factor
-    for c in range(-lctx, rctx + 1):
-        idx = th.arange(c, c + T, device=feats.device, dtype=th.int64)
-        idx = th.clamp(idx, min=0, max=T - 1)
-        ctx.append(th.index_select(feats, -2, idx))
+    feats = feats[..., :T, :]
+    # replicate the edge frames (expanded views, no index tensor to build):
+    # N x ... x (lctx+T+rctx) x F
+    edge_shape = feats.shape[:-2]
+    pad = th.cat([
+        feats[..., :1, :].expand(edge_shape + (lctx, -1)), feats,
+        feats[..., -1:, :].expand(edge_shape + (rctx, -1))
+    ], -2)
+    # N x ... x T x F x D (a view of pad)
+    splice = pad.unfold(-2, lctx + rctx + 1, 1)
     if op == "cat":
-        # N x ... x T x FD
-        splice = th.cat(ctx, -1)
-    else:
-        # N x ... x T x F x D
-        splice = th.stack(ctx, -1)
+        # N x ... x T x DF
+        splice = splice.transpose(-1, -2).reshape(splice.shape[:-2] + (-1,))
     return splice
 
 
+def _fft_frames(wav: th.Tensor,
+                kernel: th.Tensor,
+                frame_hop: int = 256,
+                pre_emphasis: float = 0,
+                onesided: bool = False) -> Tuple[th.Tensor, th.Tensor]:
+    """
+    Compute STFT with FFT (O(BlogB) per frame instead of O(BW) of conv1d)
+    Args:
+        wav (Tensor), N x S
+        kernel (Tensor), STFT transform kernels, from init_kernel(...)
+    Return:
+        real, imag (Tensor), N x F x T
+    """
+    # FFT size
+    B = kernel.shape[0] // 2
+    # the real part of the first DFT basis, i.e., the (normalized) window
+    window = kernel[0, 0]
+    if pre_emphasis == 0 and window.shape[-1] == B and not wav.is_cuda:
+        # let th.stft do the framing & windowing (faster on CPU). On GPU we
+        # keep the code below to align the cuFFT batch size
+        spec = th.stft(wav,
+                       B,
+                       hop_length=frame_hop,
+                       window=window,
+                       center=False,
+                       onesided=onesided,
+                       return_complex=True)
+        # 2 x N x F x T
+        packed = th.view_as_real(spec).permute(3, 0, 1, 2).contiguous()
+        return packed[0], packed[1]
+    # N x T x W (view)
+    frames = wav.unfold(-1, window.shape[-1], frame_hop)
+    if pre_emphasis > 0:
+        frames = th.cat([
+            frames[..., :1], frames[..., 1:] - pre_emphasis * frames[..., :-1]
+        ], -1)
+    N, T, W = frames.shape
+    frames = frames.reshape(N * T, W) * window
+    # cuFFT plans are cached by the shape, including the batch size, which
+    # varies with each minibatch. Rounding it up makes the cached plans reusable
+    if frames.is_cuda and (N * T) % FFT_BATCH_ALIGN:
+        frames = tf.pad(frames, (0, 0, 0, -(N * T) % FFT_BATCH_ALIGN))
+    # NT x F
+    if onesided:
+        spec = th.fft.rfft(frames, n=B, dim=-1)
+    else:
+        spec = th.fft.fft(frames, n=B, dim=-1)
+    # N x T x F
+    spec = spec[:N * T].view(N, T, -1)
+    # 2 x N x F x T
+    packed = th.view_as_real(spec).permute(3, 0, 2, 1).contiguous()
+    return packed[0], packed[1]
+
+
+def _ifft_frames(real: th.Tensor,
+                 imag: th.Tensor,
+                 kernel: th.Tensor,
+                 onesided: bool = False) -> th.Tensor:
+    """
+    Compute the windowed frames of iSTFT with inverse FFT (instead of the
+    conv_transpose1d with the iDFT kernel)
+    Args:
+        real, imag (Tensor), N x F x T
+        kernel (Tensor), iSTFT transform kernels, from init_kernel(...)
+    Return:
+        frames (Tensor), N x W x T
+    """
+    # FFT size
+    B = kernel.shape[0] // 2
+    # the real part of the first iDFT basis, i.e., window x normalization
+    # factor, scaled by B as (i)rfft already divides the output by it
+    window = kernel[0, 0] * B
+    # N x F x T
+    spec = th.complex(real, imag)
+    # N x B x T
+    if onesided:
+        frames = th.fft.irfft(spec, n=B, dim=-2)
+    else:
+        frames = th.fft.ifft(spec, n=B, dim=-2).real
+    # N x W x T
+    return frames[:, :window.shape[-1]] * window[:, None]
+
+
+@th.jit.script
+def _polar(real: th.Tensor, imag: th.Tensor,
+           eps: float) -> Tuple[th.Tensor, th.Tensor]:
+    """
+    Return (magnitude, phase), scripted so that the element-wise ops can be
+    fused (instead of allocating real**2, imag**2 and their sum)
+    """
+    mag = th.sqrt(real * real + imag * imag + eps)
+    pha = th.atan2(imag, real)
+    return mag, pha
+
+
 def _forward_stft(
         wav: th.Tensor,
         kernel: th.Tensor,
@@ -243,34 +373,44 @@ def _forward_stft(
         # NOTE: match with librosa
         wav = tf.pad(wav, (pad, pad), mode="reflect")
     # STFT
-    if pre_emphasis > 0:
-        # NC x W x T
-        frames = tf.unfold(wav[:, None], (1, kernel.shape[-1]),
-                           stride=frame_hop,
-                           padding=0)
-        frames[:, 1:] = frames[:, 1:] - pre_emphasis * frames[:, :-1]
-        # 1 x 2B x W, NC x W x T,  NC x 2B x T
-        packed = th.matmul(kernel[:, 0][None, ...], frames)
+    if USE_FFT:
+        real, imag = _fft_frames(wav[:, 0],
+                                 kernel,
+                                 frame_hop=frame_hop,
+                                 pre_emphasis=pre_emphasis,
+                                 onesided=onesided)
+        # NC x F x T => N x C x F x T
+        if wav_dim == 3:
+            real = real.view(N, -1, real.shape[-2], real.shape[-1])
+            imag = imag.view(N, -1, imag.shape[-2], imag.shape[-1])
     else:
-        packed = tf.conv1d(wav, kernel, stride=frame_hop, padding=0)
-    # NC x 2B x T => N x C x 2B x T
-    if wav_dim == 3:
-        packed = packed.view(N, -1, packed.shape[-2], packed.shape[-1])
-    # N x (C) x B x T
-    real, imag = th.chunk(packed, 2, dim=-2)
-    # N x (C) x B/2+1 x T
-    if onesided:
-        num_bins = kernel.shape[0] // 4 + 1
-        real = real[..., :num_bins, :]
-        imag = imag[..., :num_bins, :]
+        if onesided:
+            # only compute the onesided bins: 2(B/2+1) x 1 x W
+            B, num_bins = kernel.shape[0] // 2, kernel.shape[0] // 4 + 1
+            kernel = th.cat(
+                [kernel.narrow(0, 0, num_bins),
+                 kernel.narrow(0, B, num_bins)])
+        if pre_emphasis > 0:
+            # NC x W x T
+            frames = tf.unfold(wav[:, None], (1, kernel.shape[-1]),
+                               stride=frame_hop,
+                               padding=0)
+            frames[:, 1:] = frames[:, 1:] - pre_emphasis * frames[:, :-1]
+            # 1 x 2B x W, NC x W x T,  NC x 2B x T
+            packed = th.matmul(kernel[:, 0][None, ...], frames)
+        else:
+            packed = tf.conv1d(wav, kernel, stride=frame_hop, padding=0)
+        # NC x 2B x T => N x C x 2B x T
+        if wav_dim == 3:
+            packed = packed.view(N, -1, packed.shape[-2], packed.shape[-1])
+        # N x (C) x B x T (or B/2+1 if onesided)
+        real, imag = th.chunk(packed, 2, dim=-2)
     if output == "complex":
         return (real, imag)
     elif output == "real":
         return th.stack([real, imag], dim=-1)
     else:
-        mag = (real**2 + imag**2 + EPSILON)**0.5
-        pha = th.atan2(imag, real)
-        return (mag, pha)
+        return _polar(real, imag, float(EPSILON))
 
 
 def _inverse_stft(transform: Union[th.Tensor, Tuple[th.Tensor, th.Tensor]],
@@ -301,8 +441,13 @@ def _inverse_stft(transform: Union[th.Tensor, Tuple[th.Tensor, th.Tensor]],
     if input == "real":
         real, imag = transform[..., 0], transform[..., 1]
     elif input == "polar":
-        real = transform[0] * th.cos(transform[1])
-        imag = transform[0] * th.sin(transform[1])
+        if USE_POLAR:
+            # one kernel instead of cos, sin and two multiplications
+            cplx = th.polar(transform[0], transform[1])
+            real, imag = cplx.real, cplx.imag
+        else:
+            real = transform[0] * th.cos(transform[1])
+            imag = transform[0] * th.sin(transform[1])
     else:
         real, imag = transform
 
@@ -316,36 +461,72 @@ def _inverse_stft(transform: Union[th.Tensor, Tuple[th.Tensor, th.Tensor]],
         real = th.unsqueeze(real, 0)
         imag = th.unsqueeze(imag, 0)
 
-    if onesided:
-        # [self.num_bins - 2, ..., 1]
-        reverse = range(kernel.shape[0] // 4 - 1, 0, -1)
-        # extend matrix: N x B x T
-        real = th.cat([real, real[:, reverse]], 1)
-        imag = th.cat([imag, -imag[:, reverse]], 1)
-    # pack: N x 2B x T
-    packed = th.cat([real, imag], dim=1)
-    # N x 1 x T
-    s = tf.conv_transpose1d(packed, kernel, stride=frame_hop, padding=0)
+    num_frames = imag.shape[-1]
+    if USE_FFT:
+        # N x W x T
+        frames = _ifft_frames(real, imag, kernel, onesided=onesided)
+        # overlap-add: N x 1 x S
+        s = tf.fold(frames,
+                    output_size=(1, (num_frames - 1) * frame_hop +
+                                 frames.shape[1]),
+                    kernel_size=(1, frames.shape[1]),
+                    stride=(1, frame_hop))[:, 0]
+    else:
+        if onesided:
+            # mirror [self.num_bins - 2, ..., 1] (flip: no host index tensor)
+            num_bins = kernel.shape[0] // 4 + 1
+            # extend matrix: N x B x T
+            real = th.cat([real, th.flip(real[:, 1:num_bins - 1], [1])], 1)
+            imag = th.cat([imag, -th.flip(imag[:, 1:num_bins - 1], [1])], 1)
+        # pack: N x 2B x T
+        packed = th.cat([real, imag], dim=1)
+        # N x 1 x S
+        s = tf.conv_transpose1d(packed, kernel, stride=frame_hop, padding=0)
     # normalized audio samples
     # refer: https://github.com/pytorch/audio/blob/2ebbbf511fb1e6c47b59fd32ad7e66023fa0dff1/torchaudio/functional.py#L171
-    # 1 x W x T
-    win = th.repeat_interleave(window[None, ..., None],
-                               packed.shape[-1],
-                               dim=-1)
-    # W x 1 x W
-    I = th.eye(window.shape[0], device=win.device)[:, None]
-    # 1 x 1 x T
-    norm = tf.conv_transpose1d(win**2, I, stride=frame_hop, padding=0)
+    # 1 x W x T (expanded view of the squared window, no copy)
+    win = (window**2)[None, :, None].expand(-1, -1, num_frames)
+    # overlap-add of the squared window (fold, instead of conv_transpose1d
+    # with a W x 1 x W identity kernel): 1 x 1 x S
+    norm = tf.fold(win,
+                   output_size=(1, s.shape[-1]),
+                   kernel_size=(1, window.shape[0]),
+                   stride=(1, frame_hop))[:, 0]
     if center:
         pad = kernel.shape[-1] // 2
         s = s[..., pad:-pad]
         norm = norm[..., pad:-pad]
-    s = s / (norm + EPSILON)
+    # the denominator is floored (no norm == 0 check & select) and inverted
+    # on the small 1 x 1 x S tensor, so the N x S signal sees one multiply
+    s = s * th.reciprocal(norm + EPSILON)
     # N x S
     s = s.squeeze(1)
     return s
 
 
+@lru_cache(maxsize=32)
+def _cached_kernel(frame_len: int, frame_hop: int, window: str,
+                   round_pow_of_two: bool, normalized: bool, inverse: bool,
+                   mode: str, device: th.device) -> Tuple[th.Tensor, th.Tensor]:
+    """
+    Return STFT kernel & window on the given device. Cached for the functional
+    forward_stft/inverse_stft, which would otherwise rebuild them (a B x B DFT
+    and a host to device copy) on each call. The tensors are shared, do not
+    modify them in place
+    """
+    # NOTE: the first call may come from the decoding code (under inference
+    # mode), but the cached tensors must remain usable in autograd
+    with inference_mode(False):
+        K, w = init_kernel(frame_len,
+                           frame_hop,
+                           init_window(window, frame_len),
+                           round_pow_of_two=round_pow_of_two,
+                           normalized=normalized,
+                           inverse=inverse,
+                           mode=mode)
+        return K.to(device), w.to(device)
+
+
 def forward_stft(
         wav: th.Tensor,
         frame_len: int,
@@ -374,15 +555,10 @@ def forward_stft(
         inverse: using iDFT kernel (for iSTFT)
         mode: "kaldi"|"librosa", slight difference on applying window function
     """
-    K, _ = init_kernel(frame_len,
-                       frame_hop,
-                       init_window(window, frame_len),
-                       round_pow_of_two=round_pow_of_two,
-                       normalized=normalized,
-                       inverse=False,
-                       mode=mode)
+    K, _ = _cached_kernel(frame_len, frame_hop, window, round_pow_of_two,
+                          normalized, False, mode, wav.device)
     return _forward_stft(wav,
-                         K.to(wav.device),
+                         K,
                          output=output,
                          frame_hop=frame_hop,
                          pre_emphasis=pre_emphasis,
@@ -418,16 +594,11 @@ def inverse_stft(transform: Union[th.Tensor, Tuple[th.Tensor, th.Tensor]],
         device = transform.device
     else:
         device = transform[0].device
-    K, w = init_kernel(frame_len,
-                       frame_hop,
-                       init_window(window, frame_len),
-                       round_pow_of_two=round_pow_of_two,
-                       normalized=normalized,
-                       inverse=True,
-                       mode=mode)
+    K, w = _cached_kernel(frame_len, frame_hop, window, round_pow_of_two,
+                          normalized, True, mode, device)
     return _inverse_stft(transform,
-                         K.to(device),
-                         w.to(device),
+                         K,
+                         w,
                          input=input,
                          frame_hop=frame_hop,
                          onesided=onesided,
@@ -494,7 +665,8 @@ class STFTBase(nn.Module):
                 f"Audio samples less than frame_len ({self.frame_len})")
         kernel_size = self.K.shape[-1]
         if self.center:
-            wav_len += kernel_size
+            # NOTE: not in-place, wav_len is owned by the caller
+            wav_len = wav_len + kernel_size
         return (wav_len - kernel_size) // self.frame_hop + 1
 
     def extra_repr(self) -> str:
@@ -509,6 +681,7 @@ class STFT(STFTBase):
     def __init__(self, *args, **kwargs):
         super(STFT, self).__init__(*args, inverse=False, **kwargs)
 
+    @compiled
     def forward(
             self,
             wav: th.Tensor,
@@ -538,6 +711,7 @@ class iSTFT(STFTBase):
     def __init__(self, *args, **kwargs):
         super(iSTFT, self).__init__(*args, inverse=True, **kwargs)
 
+    @compiled
     def forward(self,
                 transform: Union[th.Tensor, Tuple[th.Tensor, th.Tensor]],
                 input: str = "polar") -> th.Tensor:
@@ -12,7 +12,10 @@ import logging
 import torch as th
 import numpy as np
 
-from typing import NoReturn, Tuple, Any, Union, Optional
+from os import environ
+from functools import wraps
+from typing import NoReturn, Tuple, Any, Union, Optional, Callable
+from aps.const import TORCH_VERSION
 
 aps_logger_format = ("%(asctime)s [%(pathname)s:%(lineno)s - " +
                      "%(levelname)s ] %(message)s")
@@ -76,7 +79,10 @@ def load_obj(obj: Any, device: Union[th.device, str]) -> Any:
     """
 
     def cuda(obj):
-        return obj.to(device) if isinstance(obj, th.Tensor) else obj
+        if not isinstance(obj, th.Tensor):
+            return obj
+        # non-blocking copy takes effect for the tensors in pinned memory
+        return obj.to(device, non_blocking=True)
 
     if isinstance(obj, dict):
         return {key: load_obj(obj[key], device) for key in obj}
@@ -86,6 +92,47 @@ def load_obj(obj: Any, device: Union[th.device, str]) -> Any:
         return cuda(obj)
 
 
+def compiled(fn: Callable) -> Callable:
+    """
+    Decorator that runs fn through torch.compile(fn, dynamic=True) if
+    APS_TORCH_COMPILE=1 and torch >= 2.0, otherwise in eager mode. The
+    compiled callable is created on the first call and kept in the closure,
+    so the nn.Module instances stay picklable
+    """
+    compiled_fn = None
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal compiled_fn
+        use_compile = environ.get("APS_TORCH_COMPILE", "0") == "1"
+        if not use_compile or TORCH_VERSION < (2, 0):
+            return fn(*args, **kwargs)
+        if compiled_fn is None:
+            # input lengths vary from batch to batch
+            compiled_fn = th.compile(fn, dynamic=True)
+        return compiled_fn(*args, **kwargs)
+
+    return wrapper
+
+
+def inference_mode(mode: bool = True):
+    """
+    Return th.inference_mode(mode) context (no version counter & view
+    tracking) if torch >= 1.9, otherwise th.no_grad()
+    """
+    if TORCH_VERSION >= (1, 9):
+        return th.inference_mode(mode)
+    return th.no_grad()
+
+
+def bf16_supported(tensor: th.Tensor) -> bool:
+    """
+    Return true if bfloat16 matmul is supported on the device of the tensor
+    """
+    return tensor.is_cuda and hasattr(
+        th.cuda, "is_bf16_supported") and th.cuda.is_bf16_supported()
+
+
 def get_device_ids(device_ids: Union[str, int]) -> Tuple[int]:
     """
     Got device ids
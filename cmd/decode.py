@@ -10,7 +10,9 @@ import numpy as np
 import torch as th
 
 from pathlib import Path
+from typing import Iterator, List, Tuple
 from aps.eval import NnetEvaluator, TextPostProcessor
+from aps.loader.am.utils import prefetch_iter
 from aps.opts import DecodingParser
 from aps.utils import get_logger, io_wrapper, SimpleTimer
 from aps.loader import AudioReader
@@ -62,13 +64,53 @@ class FasterDecoder(NnetEvaluator):
                     f"{self.epoch}, tag: {cpt_tag}")
         logger.info(f"Using decoding function: {function}")
 
+    def to_device(self, src: np.ndarray) -> th.Tensor:
+        """
+        Copy the numpy array to the decoding device, for GPU we go through the
+        pinned memory so that the HtoD copy is asynchronous
+        """
+        src = th.from_numpy(src)
+        if self.device.type == "cuda":
+            return src.pin_memory().to(self.device, non_blocking=True)
+        return src
+
     def run(self, src, **kwargs):
-        src = th.from_numpy(src).to(self.device)
+        src = self.to_device(src)
         if self.function == "greedy_search":
             return self.decode(src)
         else:
             return self.decode(src, **kwargs)
 
+    def run_batch(self, srcs, **kwargs):
+        return self.nnet.beam_search_batch(
+            [self.to_device(src) for src in srcs], **kwargs)
+
+
+def read_batches(src_reader: Iterator, batch_size: int,
+                 accept_raw: bool) -> Iterator[List[Tuple]]:
+    """
+    Group the (key, src) pairs from the reader into batches, sorted by the
+    length (descending) in each batch
+    """
+    axis = -1 if accept_raw else 0
+    batch = []
+    for key, src in src_reader:
+        batch.append((key, src))
+        if len(batch) == batch_size:
+            yield sorted(batch, key=lambda b: b[1].shape[axis], reverse=True)
+            batch = []
+    if batch:
+        yield sorted(batch, key=lambda b: b[1].shape[axis], reverse=True)
+
+
+def write_buffer(fd, buf: List[str]) -> None:
+    """
+    Write the buffered lines out and clear the buffer
+    """
+    fd.writelines(buf)
+    fd.flush()
+    buf.clear()
+
 
 def run(args):
     print(f"Arguments in args:\n{pprint.pformat(vars(args))}", flush=True)
@@ -77,6 +119,10 @@ def run(args):
                             cpt_tag=args.am_tag,
                             function=args.function,
                             device_id=args.device_id)
+    if args.batch_size > 1 and (args.function != "beam_search" or
+                                not hasattr(decoder.nnet, "beam_search_batch")):
+        raise RuntimeError("--batch-size > 1 requires the AM to support " +
+                           "beam_search_batch (with --function beam_search)")
     if decoder.accept_raw:
         src_reader = AudioReader(args.feats_or_wav_scp,
                                  sr=args.sr,
@@ -123,30 +169,45 @@ def run(args):
         filter(lambda x: x[0] in beam_search_params,
                vars(args).items()))
     dec_args["lm"] = lm
-    for key, src in src_reader:
-        logger.info(f"Decoding utterance {key}...")
-        nbest_hypos = decoder.run(src, **dec_args)
-        nbest = [f"{key}\n"]
-        for idx, hyp in enumerate(nbest_hypos):
-            # remove SOS/EOS
-            token = hyp["trans"][1:-1]
-            trans = processor.run(token)
-            score = hyp["score"]
-            nbest.append(f"{score:.3f}\t{len(token):d}\t{trans}\n")
-            if idx == 0:
-                top1.write(f"{key}\t{trans}\n")
-            if ali_dir:
-                if hyp["align"] is None:
-                    raise RuntimeError(
-                        "Can not dump alignment out as it's None")
-                np.save(f"{ali_dir}/{key}-nbest{idx+1}", hyp["align"].numpy())
-        if topn:
-            topn.write("".join(nbest))
-        if not (N + 1) % 10:
-            top1.flush()
-            if topn:
-                topn.flush()
-        N += 1
+    # buffered lines, written out every --flush-every utterances
+    top1_buf, topn_buf = [], []
+    src_iter = iter(src_reader)
+    if args.prefetch > 0:
+        src_iter = prefetch_iter(src_iter, args.prefetch)
+    for batch in read_batches(src_iter, args.batch_size, decoder.accept_raw):
+        if args.batch_size == 1:
+            key, src = batch[0]
+            logger.info(f"Decoding utterance {key}...")
+            batch_nbest = [decoder.run(src, **dec_args)]
+        else:
+            logger.info(f"Decoding utterance {', '.join(k for k, _ in batch)}")
+            batch_nbest = decoder.run_batch([src for _, src in batch],
+                                            **dec_args)
+        for (key, _), nbest_hypos in zip(batch, batch_nbest):
+            nbest = [f"{key}\n"]
+            for idx, hyp in enumerate(nbest_hypos):
+                # remove SOS/EOS
+                token = hyp["trans"][1:-1]
+                trans = processor.run(token)
+                score = hyp["score"]
+                nbest.append(f"{score:.3f}\t{len(token):d}\t{trans}\n")
+                if idx == 0:
+                    top1_buf.append(f"{key}\t{trans}\n")
+                if ali_dir:
+                    if hyp["align"] is None:
+                        raise RuntimeError(
+                            "Can not dump alignment out as it's None")
+                    np.save(f"{ali_dir}/{key}-nbest{idx+1}",
+                            hyp["align"].numpy())
+            topn_buf += nbest
+            N += 1
+            if not N % args.flush_every:
+                write_buffer(top1, top1_buf)
+                if topn:
+                    write_buffer(topn, topn_buf)
+    write_buffer(top1, top1_buf)
+    if topn:
+        write_buffer(topn, topn_buf)
     if not stdout_top1:
         top1.close()
     if topn and not stdout_topn:
@@ -167,5 +228,20 @@ if __name__ == "__main__":
                         choices=["beam_search", "greedy_search"],
                         default="beam_search",
                         help="Name of the decoding function")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        default=1,
+                        help="Number of utterances decoded in one batch "
+                        "(beam_search_batch is used if > 1)")
+    parser.add_argument("--prefetch",
+                        type=int,
+                        default=4,
+                        help="Number of utterances loaded in a background "
+                        "thread ahead of decoding (0 to disable)")
+    parser.add_argument("--flush-every",
+                        type=int,
+                        default=32,
+                        help="Write the decoding results out every "
+                        "#flush-every utterances")
     args = parser.parse_args()
     run(args)
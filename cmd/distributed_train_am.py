@@ -9,6 +9,7 @@ import argparse
 
 from aps.utils import set_seed
 from aps.conf import load_am_conf
+from aps.loader.am.utils import TransformCollate
 from aps.opts import DistributedTrainParser
 from aps.libs import aps_transform, aps_task, aps_dataloader, aps_asr_nnet, aps_trainer
 from aps import distributed
@@ -66,6 +67,18 @@ def train_worker(task, conf, vocab_dict, args):
                                 args.dev_batch_factor,
                                 **load_conf,
                                 **data_conf["valid"])
+    # compute the features in the dataloader
+    if conf["nnet_conf"].get("precompute_features", False):
+        if "asr_transform" not in conf:
+            raise RuntimeError("precompute_features requires asr_transform " +
+                               "in the configuration")
+        if "enh_transform" in conf:
+            raise RuntimeError("precompute_features is not supported with " +
+                               "enh_transform")
+        for loader, train in [(trn_loader, True), (dev_loader, False)]:
+            transform = aps_transform("asr")(**conf["asr_transform"])
+            loader.collate_fn = TransformCollate(loader.collate_fn,
+                                                 transform.train(train))
     trainer.run(trn_loader,
                 dev_loader,
                 num_epochs=args.epochs,
@@ -10,6 +10,7 @@ import argparse
 from aps.utils import set_seed
 from aps.opts import BaseTrainParser
 from aps.conf import load_am_conf
+from aps.loader.am.utils import TransformCollate
 from aps.libs import aps_transform, aps_task, aps_dataloader, aps_asr_nnet, aps_trainer
 
 
@@ -32,6 +33,18 @@ def run(args):
     load_conf.update(data_conf["loader"])
     trn_loader = aps_dataloader(train=True, **data_conf["train"], **load_conf)
     dev_loader = aps_dataloader(train=False, **data_conf["valid"], **load_conf)
+    # compute the features in the dataloader
+    if conf["nnet_conf"].get("precompute_features", False):
+        if "asr_transform" not in conf:
+            raise RuntimeError("precompute_features requires asr_transform " +
+                               "in the configuration")
+        if "enh_transform" in conf:
+            raise RuntimeError("precompute_features is not supported with " +
+                               "enh_transform")
+        for loader, train in [(trn_loader, True), (dev_loader, False)]:
+            transform = aps_transform("asr")(**conf["asr_transform"])
+            loader.collate_fn = TransformCollate(loader.collate_fn,
+                                                 transform.train(train))
 
     asr_cls = aps_asr_nnet(conf["nnet"])
     asr_transform = None
@@ -4,10 +4,27 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import pytest
+import numpy as np
 import torch as th
 
+from torch.nn.utils.rnn import pad_sequence
 from aps.libs import aps_dataloader
 from aps.conf import load_dict
+from aps.const import IGNORE_ID
+from aps.transform import AsrTransform
+from aps.loader.am.utils import collate_egs, TokenReader, BatchSampler, TransformCollate
+
+
+class TokenDataset(object):
+    """
+    Dataset with the token reader only (for BatchSampler)
+    """
+
+    def __init__(self, token_reader):
+        self.token_reader = token_reader
+
+    def __len__(self):
+        return len(self.token_reader)
 
 
 @pytest.mark.parametrize("batch_size", [1, 2, 4])
@@ -154,3 +171,111 @@ def test_lm_bptt_loader(batch_size, obj):
         print(egs)
         assert egs["src"].shape == egs["tgt"].shape
         assert egs["src"].shape == th.Size([batch_size, 10])
+
+
+@pytest.mark.parametrize("time_axis,shape", [(0, [80]), (-1, [4]), (-1, [])])
+def test_collate_egs(time_axis, shape):
+    vocab_size = 100
+    egs = []
+    for dur, num_toks in zip([50, 80, 30, 80], [5, 3, 8, 4]):
+        inp_shape = [dur] + shape if time_axis == 0 else shape + [dur]
+        egs.append({
+            "inp": np.random.rand(*inp_shape).astype(np.float32),
+            "ref": np.random.randint(0, vocab_size, num_toks),
+            "dur": dur,
+            "len": num_toks
+        })
+    batch = collate_egs(egs, time_axis=time_axis)
+    # reference: pad_sequence along the time axis
+    src_ref = pad_sequence(
+        [th.from_numpy(np.moveaxis(eg["inp"], time_axis, 0)) for eg in egs],
+        batch_first=True,
+        padding_value=0)
+    src_ref = th.movedim(src_ref, 1, time_axis % (len(shape) + 1) + 1)
+    tgt_ref = pad_sequence([th.from_numpy(eg["ref"]) for eg in egs],
+                           batch_first=True,
+                           padding_value=IGNORE_ID)
+    assert batch["#utt"] == len(egs)
+    assert batch["#tok"] == sum(eg["len"] + 1 for eg in egs)
+    assert batch["src_pad"].dtype == th.float32
+    assert th.equal(batch["src_pad"], src_ref)
+    assert batch["tgt_pad"].dtype == th.int32
+    assert th.equal(batch["tgt_pad"], tgt_ref.int())
+    for key, ref in zip(["src_len", "tgt_len"], ["dur", "len"]):
+        assert batch[key].dtype == th.int32
+        assert batch[key].tolist() == [eg[ref] for eg in egs]
+
+
+def test_token_reader(tmp_path):
+    egs_dir = "data/dataloader/am"
+    vocab_dict = load_dict(f"{egs_dir}/dict")
+    utt2dur = {}
+    with open(f"{egs_dir}/egs.utt2dur") as fd:
+        for line in fd:
+            key, dur = line.split()
+            utt2dur[key] = float(dur)
+    text = {}
+    with open(f"{egs_dir}/egs.fake.text") as fd:
+        for line in fd:
+            key, *tokens = line.split()
+            text[key] = tokens
+    # make some ties on the duration
+    for i, key in enumerate(utt2dur):
+        utt2dur[key] = round(utt2dur[key]) if i % 2 else utt2dur[key]
+    with open(tmp_path / "utt2dur", "w") as fd:
+        for key, dur in utt2dur.items():
+            fd.write(f"{key} {dur}\n")
+    skip_utts = list(text)[:2]
+    with open(tmp_path / "skip_utts", "w") as fd:
+        fd.write("\n".join(skip_utts) + "\n")
+    reader = TokenReader(f"{egs_dir}/egs.fake.text",
+                         str(tmp_path / "utt2dur"),
+                         vocab_dict,
+                         max_token_num=20,
+                         min_token_num=5,
+                         max_dur=100,
+                         min_dur=0,
+                         skip_utts=str(tmp_path / "skip_utts"))
+    # reference: filter & sort by duration and then #tokens (long -> short)
+    ref = [
+        key for key in text
+        if key in utt2dur and key not in skip_utts and 5 <= len(text[key]) <= 20
+    ]
+    ref = sorted(ref, key=lambda k: (utt2dur[k], len(text[k])), reverse=True)
+    assert len(reader) == len(ref)
+    for i, key in enumerate(ref):
+        utt = reader[i]
+        assert utt["key"] == key
+        assert utt["dur"] == utt2dur[key]
+        assert utt["len"] == len(text[key])
+        assert utt["tok"].tolist() == [vocab_dict[t] for t in text[key]]
+    # batches are the consecutive spans of the sorted utterances
+    dataset = TokenDataset(reader)
+    sampler = BatchSampler(dataset, 4, adapt_dur=5, min_batch_size=1)
+    assert sum(list(sampler), []) == list(range(len(ref)))
+
+
+@pytest.mark.parametrize("requires_grad", [True, False])
+def test_transform_collate(requires_grad):
+    transform = AsrTransform(feats="fbank-log-cmvn",
+                             frame_len=400,
+                             frame_hop=160,
+                             requires_grad=requires_grad)
+    egs = []
+    for dur, num_toks in zip([16000, 8000, 12000], [5, 3, 8]):
+        egs.append({
+            "inp": np.random.rand(dur).astype(np.float32),
+            "ref": np.random.randint(0, 100, num_toks),
+            "dur": dur,
+            "len": num_toks
+        })
+    if requires_grad:
+        with pytest.raises(RuntimeError):
+            TransformCollate(collate_egs, transform)
+    else:
+        collate_fn = TransformCollate(collate_egs, transform.eval())
+        batch = collate_fn(egs)
+        feats, num_frames = transform(
+            collate_egs(egs)["src_pad"], th.tensor([eg["dur"] for eg in egs]))
+        assert th.allclose(batch["src_pad"], feats)
+        assert batch["src_len"].tolist() == num_frames.tolist()
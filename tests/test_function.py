@@ -9,10 +9,13 @@ import torch.nn as nn
 
 from aps.libs import dynamic_importlib, ApsRegisters, ApsModules
 from aps.conf import load_dict
+from aps.eval import TextPostProcessor
 from aps.asr.xfmr.pose import digit_shift
 from aps.asr.xfmr.decoder import prep_sub_mask
 from aps.asr.xfmr.impl import ApsMultiheadAttention
 from aps.asr.base.attention import padding_mask
+from aps.cplx import ComplexTensor
+from aps.asr.filter.mvdr import estimate_covar
 
 
 @pytest.mark.parametrize(
@@ -28,6 +31,18 @@ def test_load_dict(str_dict):
     load_dict(str_dict, reverse=True)
 
 
+@pytest.mark.parametrize("str_dict", ["data/checkpoint/aishell_att_1a/dict"])
+def test_text_post_processor(str_dict):
+    vocab = load_dict(str_dict, reverse=True)
+    processor = TextPostProcessor(str_dict, space="<space>")
+    int_seq = sorted(vocab)[-10:]
+    trans = "".join(vocab[idx] for idx in int_seq).replace("<space>", " ")
+    assert processor.run(int_seq) == trans
+    for idx in [-1, max(vocab) + 1]:
+        with pytest.raises(KeyError):
+            processor.run(int_seq + [idx])
+
+
 @pytest.mark.parametrize(
     "package", ["asr", "sse", "task", "loader", "trainer", "transform"])
 def test_register(package):
@@ -98,3 +113,27 @@ def test_aps_selfattn(index):
     assert my2.shape == th2.shape
     th.testing.assert_allclose(my2, th2)
     th.testing.assert_allclose(my1, th1)
+
+
+@pytest.mark.parametrize("dtype", [th.float32, th.bfloat16])
+def test_cplx_matmul(dtype):
+    N, C, T = 4, 8, 16
+    a = ComplexTensor(th.rand(N, C, T), th.rand(N, C, T))
+    b = ComplexTensor(th.rand(N, T, C), th.rand(N, T, C))
+    ref = a @ b
+    out = a.to(dtype) @ b.to(dtype)
+    assert out.real.dtype == dtype
+    tol = 1e-5 if dtype == th.float32 else 2e-1
+    th.testing.assert_allclose(out.real.float(), ref.real, atol=tol, rtol=tol)
+    th.testing.assert_allclose(out.imag.float(), ref.imag, atol=tol, rtol=tol)
+
+
+def test_bf16_covar():
+    N, C, F, T = 2, 4, 65, 50
+    spec = ComplexTensor(th.randn(N, C, F, T), th.randn(N, C, F, T))
+    mask = th.rand(N, F, T)
+    ref = estimate_covar(mask, spec)
+    out = estimate_covar(mask, spec, bf16=True)
+    assert out.real.dtype == th.float32 and out.shape == ref.shape
+    th.testing.assert_allclose(out.real, ref.real, atol=5e-2, rtol=5e-2)
+    th.testing.assert_allclose(out.imag, ref.imag, atol=5e-2, rtol=5e-2)
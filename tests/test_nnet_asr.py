@@ -382,6 +382,74 @@ def test_beam_att(enh_type, enh_kwargs):
     assert z.shape == th.Size([4, u + 1, vocab_size - 1])
 
 
+@pytest.mark.parametrize("batch_len", [[50, 40, 30, 20], [20, 50, 30]])
+def test_beam_search_batch(batch_len):
+    nnet_cls = aps_asr_nnet("asr@att")
+    vocab_size, beam_size, eos = 20, 4, 1
+    att_asr = nnet_cls(input_size=80,
+                       vocab_size=vocab_size,
+                       sos=0,
+                       eos=eos,
+                       att_type="ctx",
+                       att_kwargs={"att_dim": 128},
+                       enc_type="pytorch_rnn",
+                       enc_proj=128,
+                       enc_kwargs={
+                           "rnn": "lstm",
+                           "num_layers": 2,
+                           "hidden": 128
+                       },
+                       dec_dim=128,
+                       dec_kwargs={
+                           "dec_rnn": "lstm",
+                           "rnn_layers": 1,
+                           "rnn_hidden": 128
+                       })
+    att_asr.eval()
+    # utterances with unequal lengths
+    batch = [th.rand(T, 80) for T in batch_len]
+    with th.no_grad():
+        enc_out, _ = att_asr._batch_decoding_prep(batch)
+    # force each utterance to end (all beams emit eos) at a different step and
+    # only at that step, the rows in decoder are identified by their encoder
+    # output
+    end_step = {
+        enc_out[u, 0, 0].item(): T // 5 for u, T in enumerate(batch_len)
+    }
+    dec_step = att_asr.decoder.step
+    step_num = [0]
+
+    def forced_step(att_net, out_pre, enc_out, *args, **kwargs):
+        outs = dec_step(att_net, out_pre, enc_out, *args, **kwargs)
+        num_rows.append(enc_out.shape[0])
+        step_num[0] += 1
+        end = th.tensor(
+            [end_step[e] == step_num[0] for e in enc_out[:, 0, 0].tolist()])
+        outs[0][:, eos] = th.where(end, 50.0, -50.0)
+        return outs
+
+    att_asr.decoder.step = forced_step
+    nbest = {}
+    for early_stop in [True, False]:
+        step_num[0], num_rows = 0, []
+        nbest[early_stop] = att_asr.beam_search_batch(batch,
+                                                      beam_size=beam_size,
+                                                      nbest=beam_size,
+                                                      max_len=20,
+                                                      early_stop=early_stop)
+        # finished utterances are dropped from the decoder
+        assert num_rows[-1] == (beam_size if early_stop else len(batch) *
+                                beam_size)
+    for u, T in enumerate(batch_len):
+        hyps, ref = nbest[True][u], nbest[False][u]
+        assert len(hyps) == len(ref) == beam_size
+        for hyp, ref_hyp in zip(hyps, ref):
+            # sos + tokens + eos (emitted at step T // 5)
+            assert len(hyp["trans"]) == T // 5 + 1
+            assert hyp["trans"] == ref_hyp["trans"]
+            assert abs(hyp["score"] - ref_hyp["score"]) < 1e-4
+
+
 @pytest.mark.parametrize("enc_type,enc_kwargs", [
     pytest.param("variant_rnn", custom_rnn_enc_kwargs),
     pytest.param("conv1d", conv1d_enc_kwargs),
@@ -539,3 +607,30 @@ def test_xfmr_transducer(enc_type, enc_kwargs):
     x, x_len, y, y_len, u = gen_egs(vocab_size, batch_size)
     z, _ = xfmr_rnnt(x, x_len, y, y_len)
     assert z.shape[2:] == th.Size([u + 1, vocab_size])
+
+
+@pytest.mark.parametrize("num_layers", [1, 2])
+def test_xfmr_lm(num_layers):
+    nnet_cls = aps_asr_nnet("asr@xfmr_lm")
+    vocab_size, batch_size, num_steps = 100, 4, 10
+    xfmr_lm = nnet_cls(vocab_size=vocab_size,
+                       att_dim=256,
+                       nhead=4,
+                       feedforward_dim=512,
+                       pos_dropout=0,
+                       att_dropout=0,
+                       ffn_dropout=0,
+                       num_layers=num_layers)
+    token = th.randint(0, vocab_size, (batch_size, num_steps))
+    with th.no_grad():
+        # training: process whole sequence
+        xfmr_lm.train()
+        ref, _ = xfmr_lm(token, None, th.full((batch_size,), num_steps))
+        assert ref.shape == th.Size([batch_size, num_steps, vocab_size])
+        # inference: step by step using key/value cache
+        xfmr_lm.eval()
+        cache = None
+        for t in range(num_steps):
+            out, cache = xfmr_lm(token[:, t:t + 1], cache)
+            th.testing.assert_allclose(out[:, 0], ref[:, t])
+    assert cache[0][0].shape[0] == num_steps
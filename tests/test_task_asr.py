@@ -57,13 +57,14 @@ def gen_asr_egs(batch_size, vocab_size):
     y_len[0] = U
     for i, n in enumerate(y_len.tolist()):
         y[i, n:] = IGNORE_ID
+    # int32 as AM dataloader
     return {
         "#utt": batch_size,
         "#tok": th.sum(y_len).item() + batch_size,
-        "src_len": x_len,
+        "src_len": x_len.int(),
         "src_pad": x,
-        "tgt_len": y_len,
-        "tgt_pad": y
+        "tgt_len": y_len.int(),
+        "tgt_pad": y.int()
     }
 
 
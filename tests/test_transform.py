@@ -4,15 +4,21 @@
 # License: Apache 2.0 (http://www.apache.org/licenses/LICENSE-2.0)
 
 import math
+import pickle
 import pytest
 import librosa
 import torch as th
 
-from aps.transform.utils import forward_stft, inverse_stft
+import aps.transform.utils as stft_utils
+
+from aps.transform.utils import forward_stft, inverse_stft, init_kernel, init_window, splice_feature
+from aps.transform.utils import STFT
 from aps.cplx import ComplexTensor
 from aps.loader import read_audio
+from aps.const import TORCH_VERSION
 from aps.transform import AsrTransform, EnhTransform, FixedBeamformer, DfTransform
-from aps.transform.asr import SpeedPerturbTransform
+from aps.transform.asr import SpeedPerturbTransform, SpecAugTransform, DeltaTransform, CmvnTransform
+from aps.transform.augment import random_mask
 
 egs1_wav = read_audio("data/transform/egs1.wav", sr=16000)
 egs2_wav = read_audio("data/transform/egs2.wav", sr=16000)
@@ -35,6 +41,92 @@ def test_forward_inverse_stft(wav, frame_len, frame_hop, window, center):
     th.testing.assert_allclose(out[..., :trunc], wav[..., :trunc])
 
 
+@pytest.mark.parametrize("frame_len, frame_hop", [(512, 128), (400, 160)])
+@pytest.mark.parametrize("round_pow_of_two", [True, False])
+@pytest.mark.parametrize("mode", ["librosa", "kaldi"])
+@pytest.mark.parametrize("pre_emphasis", [0, 0.97])
+@pytest.mark.parametrize("onesided", [True, False])
+@pytest.mark.parametrize("center", [True, False])
+def test_fft_stft(frame_len, frame_hop, round_pow_of_two, mode, pre_emphasis,
+                  onesided, center, monkeypatch):
+    # compare FFT based STFT with the conv1d (DFT kernel) one
+    wav = th.rand(2, 3, 8000)
+    kernel, _ = init_kernel(frame_len,
+                            frame_hop,
+                            init_window("hann", frame_len),
+                            round_pow_of_two=round_pow_of_two,
+                            mode=mode)
+    stft_kwargs = {
+        "output": "complex",
+        "frame_hop": frame_hop,
+        "pre_emphasis": pre_emphasis,
+        "onesided": onesided,
+        "center": center
+    }
+    monkeypatch.setattr(stft_utils, "USE_FFT", True)
+    fft_real, fft_imag = stft_utils._forward_stft(wav, kernel, **stft_kwargs)
+    monkeypatch.setattr(stft_utils, "USE_FFT", False)
+    ref_real, ref_imag = stft_utils._forward_stft(wav, kernel, **stft_kwargs)
+    assert fft_real.shape == ref_real.shape
+    th.testing.assert_allclose(fft_real, ref_real, atol=1e-4, rtol=1e-4)
+    th.testing.assert_allclose(fft_imag, ref_imag, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.parametrize("frame_len, frame_hop", [(512, 128), (400, 160)])
+@pytest.mark.parametrize("round_pow_of_two", [True, False])
+@pytest.mark.parametrize("mode", ["librosa", "kaldi"])
+@pytest.mark.parametrize("normalized", [True, False])
+@pytest.mark.parametrize("onesided", [True, False])
+@pytest.mark.parametrize("center", [True, False])
+def test_fft_istft(frame_len, frame_hop, round_pow_of_two, mode, normalized,
+                   onesided, center, monkeypatch):
+    # compare inverse FFT based iSTFT with the conv_transpose1d one
+    wav = th.rand(2, 8000)
+    window = init_window("hamm", frame_len)
+    kernel_kwargs = {
+        "round_pow_of_two": round_pow_of_two,
+        "normalized": normalized,
+        "mode": mode
+    }
+    kernel, _ = init_kernel(frame_len, frame_hop, window, **kernel_kwargs)
+    ikernel, iwindow = init_kernel(frame_len,
+                                   frame_hop,
+                                   window,
+                                   inverse=True,
+                                   **kernel_kwargs)
+    stft_kwargs = {
+        "frame_hop": frame_hop,
+        "onesided": onesided,
+        "center": center
+    }
+    spec = stft_utils._forward_stft(wav, kernel, output="polar", **stft_kwargs)
+    monkeypatch.setattr(stft_utils, "USE_FFT", True)
+    out = stft_utils._inverse_stft(spec, ikernel, iwindow, **stft_kwargs)
+    monkeypatch.setattr(stft_utils, "USE_FFT", False)
+    ref = stft_utils._inverse_stft(spec, ikernel, iwindow, **stft_kwargs)
+    assert out.shape == ref.shape
+    th.testing.assert_allclose(out, ref, atol=1e-4, rtol=1e-4)
+    # round trip (skip the edges if not centered)
+    trunc = slice(0, None) if center else slice(frame_len, -frame_len)
+    th.testing.assert_allclose(out[:, trunc],
+                               wav[:, :out.shape[-1]][:, trunc],
+                               atol=1e-4,
+                               rtol=1e-4)
+
+
+def test_stft_after_inference_mode():
+    # the kernels cached on the first call (under inference mode here) should
+    # still work with autograd
+    wav = th.rand(2, 8000)
+    with th.inference_mode():
+        forward_stft(wav, 300, 75, window="hann")
+    wav.requires_grad_()
+    mag, _ = forward_stft(wav, 300, 75, window="hann")
+    inverse_stft((mag, th.zeros_like(mag)), 300, 75,
+                 window="hann").sum().backward()
+    assert wav.grad is not None
+
+
 @pytest.mark.parametrize("wav", [egs1_wav, egs2_wav[0].copy()])
 @pytest.mark.parametrize("frame_len, frame_hop", [(512, 256), (1024, 256),
                                                   (400, 160)])
@@ -162,6 +254,191 @@ def debug_visualize_feature():
     plot_feature(feats[0, 1].numpy(), "egs")
 
 
+@pytest.mark.parametrize("length,max_steps", [(100, 30), (20, 30), (50, 1)])
+def test_random_mask(length, max_steps):
+    N = 64
+    mask = random_mask(N, length, max_steps=max_steps, num_masks=1)
+    assert mask.shape == th.Size([N, length]) and mask.dtype == th.bool
+    for m in mask.tolist():
+        band = [i for i, masked in enumerate(m) if masked]
+        if not band:
+            continue
+        # one band, width in [1, max_steps - 1], last index never masked
+        assert band == list(range(band[0], band[-1] + 1))
+        assert 1 <= len(band) < min(max_steps, length)
+        assert band[-1] < length - 1
+    if max_steps <= 1:
+        assert not mask.any()
+
+
+@pytest.mark.parametrize("shape", [(8, 100, 40), (8, 2, 100, 40)])
+@pytest.mark.parametrize("mask_zero", [True, False])
+def test_spec_aug(shape, mask_zero):
+    spec_aug = SpecAugTransform(p=1,
+                                time_args=(40, 2),
+                                freq_args=(20, 2),
+                                mask_zero=mask_zero)
+    spec_aug.train()
+    x = th.rand(shape) + 1
+    y = spec_aug(x)
+    value = 0 if mask_zero else x.mean()
+    # the masked region is the union of the whole frequency bands & frames
+    mask = y != x
+    assert th.all(y[mask] == value)
+    fmask = mask.all(-2, keepdim=True)
+    tmask = mask.all(-1, keepdim=True)
+    assert th.equal(mask, fmask | tmask)
+
+
+def splice_reference(feats, lctx, rctx, subsampling_factor=1, op="cat"):
+    T = feats.shape[-2]
+    T = T - T % subsampling_factor
+    ctx = []
+    for c in range(-lctx, rctx + 1):
+        idx = th.arange(c, c + T, dtype=th.int64)
+        idx = th.clamp(idx, min=0, max=T - 1)
+        ctx.append(th.index_select(feats, -2, idx))
+    return th.cat(ctx, -1) if op == "cat" else th.stack(ctx, -1)
+
+
+@pytest.mark.parametrize("center", [True, False])
+def test_stft_num_frames(center):
+    stft = STFT(400, 160, window="hamm", center=center)
+    wav_len = th.tensor([16000, 8000, 600])
+    num_frames = stft.num_frames(wav_len)
+    assert wav_len.tolist() == [16000, 8000, 600]
+    assert num_frames.tolist() == [
+        stft(th.rand(1, n))[0].shape[-1] for n in wav_len.tolist()
+    ]
+    with pytest.raises(RuntimeError):
+        stft.num_frames(th.tensor([16000, 400]))
+
+
+@pytest.mark.parametrize("shape", [(4, 100, 40), (4, 2, 99, 40), (2, 3, 13)])
+@pytest.mark.parametrize("lctx,rctx", [(3, 3), (0, 2), (5, 0), (4, 6)])
+@pytest.mark.parametrize("subsampling_factor", [1, 3])
+@pytest.mark.parametrize("op", ["cat", "stack"])
+def test_splice(shape, lctx, rctx, subsampling_factor, op):
+    feats = th.rand(shape)
+    ref = splice_reference(feats,
+                           lctx,
+                           rctx,
+                           subsampling_factor=subsampling_factor,
+                           op=op)
+    out = splice_feature(feats,
+                         lctx=lctx,
+                         rctx=rctx,
+                         subsampling_factor=subsampling_factor,
+                         op=op)
+    assert th.equal(out, ref)
+
+
+@pytest.mark.parametrize("shape", [(4, 100, 40), (4, 2, 100, 40), (2, 3, 13)])
+@pytest.mark.parametrize("ctx,order", [(2, 2), (1, 3), (3, 1)])
+@pytest.mark.parametrize("delta_as_channel", [True, False])
+def test_delta(shape, ctx, order, delta_as_channel):
+    delta_transform = DeltaTransform(ctx=ctx,
+                                     order=order,
+                                     delta_as_channel=delta_as_channel)
+    feats = th.rand(shape)
+    scale = th.arange(-ctx, ctx + 1, dtype=th.float32)
+    scale = scale / sum(i * i for i in range(-ctx, ctx + 1))
+    delta = [feats]
+    for _ in range(order):
+        splice = splice_reference(delta[-1], ctx, ctx, op="stack")
+        delta.append(th.sum(splice * scale, -1))
+    ref = th.stack(delta, 1) if delta_as_channel else th.cat(delta, -1)
+    out = delta_transform(feats)
+    assert out.shape == ref.shape
+    th.testing.assert_allclose(out, ref, atol=1e-5, rtol=1e-4)
+
+
+def cmvn_reference(feats, norm_mean, norm_var, per_band, gmean, gstd, eps):
+    if gmean is not None:
+        if norm_mean:
+            feats = feats - gmean
+        if norm_var:
+            feats = feats / gstd
+        return feats
+    axis = -2 if per_band else (-1, -2)
+    if norm_mean:
+        feats = feats - th.mean(feats, axis, keepdim=True)
+    if norm_var:
+        if norm_mean:
+            var = th.mean(feats**2, axis, keepdim=True)
+        else:
+            var = th.var(feats, axis, unbiased=False, keepdim=True)
+        feats = feats / th.sqrt(var + eps)
+    return feats
+
+
+@pytest.mark.parametrize("shape", [(4, 100, 40), (4, 2, 100, 40)])
+@pytest.mark.parametrize("norm_mean", [True, False])
+@pytest.mark.parametrize("norm_var", [True, False])
+@pytest.mark.parametrize("per_band", [True, False])
+@pytest.mark.parametrize("global_stats", [True, False])
+def test_cmvn(shape, norm_mean, norm_var, per_band, global_stats, tmp_path):
+    gmean, gstd, gcmvn = None, None, ""
+    if global_stats:
+        gmean, gstd = th.randn(shape[-1]), th.rand(shape[-1]) + 0.5
+        gcmvn = str(tmp_path / "gcmvn.pt")
+        th.save(th.stack([gmean, gstd]), gcmvn)
+    cmvn_transform = CmvnTransform(norm_mean=norm_mean,
+                                   norm_var=norm_var,
+                                   per_band=per_band,
+                                   gcmvn=gcmvn,
+                                   eps=1e-5)
+    feats = th.randn(shape) * 3 + 2
+    ref = cmvn_reference(feats, norm_mean, norm_var, per_band, gmean, gstd,
+                         1e-5)
+    th.testing.assert_allclose(cmvn_transform(feats), ref, atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize("feats", [
+    "fbank-log-cmvn", "emph-fbank-log-cmvn-delta", "spectrogram-mel-dct",
+    "mfcc-splice"
+])
+@pytest.mark.parametrize("norm_per_band", [True, False])
+@pytest.mark.parametrize("global_stats", [True, False])
+def test_fused_transform(feats, norm_per_band, global_stats, tmp_path):
+    gcmvn = ""
+    if global_stats:
+        gcmvn = str(tmp_path / "gcmvn.pt")
+        th.save(th.stack([th.randn(80), th.rand(80) + 0.5]), gcmvn)
+    transform = AsrTransform(feats=feats,
+                             frame_len=400,
+                             frame_hop=160,
+                             num_mels=80,
+                             pre_emphasis=0.96,
+                             norm_per_band=norm_per_band,
+                             gcmvn=gcmvn)
+    transform.eval()
+    fused = (transform.fused_index >= 0 or transform.folded_index >= 0)
+    assert fused == (feats != "mfcc-splice")
+    wav = th.from_numpy(egs1_wav[None, ...])
+    # PreEmphasisTransform works in-place
+    ref = transform.transform(wav.clone())
+    out = transform._forward_fused(wav.clone())
+    assert out.shape == ref.shape
+    th.testing.assert_allclose(out, ref, atol=1e-4, rtol=1e-4)
+
+
+@pytest.mark.skipif(TORCH_VERSION < (2, 0), reason="requires torch.compile")
+def test_compiled_transform(monkeypatch):
+    transform = AsrTransform(feats="fbank-log-cmvn",
+                             frame_len=400,
+                             frame_hop=160)
+    wav = th.from_numpy(egs1_wav[None, ...])
+    monkeypatch.setenv("APS_TORCH_COMPILE", "1")
+    out, _ = transform(wav, None)
+    # no compiled callables kept on the layers (e.g., for dataloader workers)
+    transform = pickle.loads(pickle.dumps(transform))
+    th.testing.assert_allclose(transform(wav, None)[0], out)
+    monkeypatch.setenv("APS_TORCH_COMPILE", "0")
+    ref, _ = transform(wav, None)
+    th.testing.assert_allclose(out, ref, atol=1e-3, rtol=1e-3)
+
+
 def debug_speed_perturb():
     from aps.loader import write_audio
     speed_perturb = SpeedPerturbTransform(sr=16000)